@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""Measures how long deployer takes to start for each kind of CLI call.
+
+Every case runs in a fresh interpreter. Cases that would reach AWS only
+import the modules they need, which is the part deployer controls.
+
+    python benchmarks/startup.py --runs 20
+    python benchmarks/startup.py --check
+"""
+import argparse, os, shutil, subprocess, sys, tempfile, time
+
+CLI = "import sys; sys.argv[0] = 'deployer'; from deployer import main; main()"
+
+CONFIG = """global:
+  region: us-east-1
+network:
+  stack_name: network
+app:
+  stack_name: app
+  depends_on: [network]
+"""
+
+# Name, interpreter arguments and the median budget in milliseconds
+CASES = [
+    ('import', ['-c', 'import deployer'], 150),
+    ('version', ['-c', CLI, '-v'], 200),
+    ('help', ['-c', CLI, '-h'], 200),
+    ('init', ['-c', CLI, '--init', '{tmp}/skel'], 250),
+    ('plan', ['-c', CLI, '-c', '{tmp}/config.yml', '-A', '-x', 'upsert', '--plan'], 400),
+    ('describe imports', ['-c', 'import deployer.api, deployer.stack, deployer.context'], 1500),
+    ('sync imports', ['-c', 'import deployer.api, deployer.s3_sync, deployer.context'], 1500),
+]
+
+
+def measure(arguments, runs, tmp):
+    times = []
+    for x in range(runs):
+        if os.path.exists(os.path.join(tmp, 'skel')):
+            shutil.rmtree(os.path.join(tmp, 'skel'))
+        start = time.time()
+        subprocess.check_call([sys.executable] + [x.format(tmp=tmp) for x in arguments], cwd=tmp,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append((time.time() - start) * 1000)
+    times.sort()
+    return times[0], times[len(times) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark deployer startup time')
+    parser.add_argument('--runs', type=int, default=10, help='Runs of each case (default: 10)')
+    parser.add_argument('--check', action='store_true', help='Exit with 1 when a median is over its budget')
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    with open(os.path.join(tmp, 'config.yml'), 'w') as f:
+        f.write(CONFIG)
+
+    baseline = measure(['-c', 'pass'], args.runs, tmp)[1]
+    print("{:<20} {:>10} {:>10} {:>10}".format('case', 'min ms', 'median ms', 'budget ms'))
+    over = []
+    try:
+        for name, arguments, budget in CASES:
+            fastest, median = measure(arguments, args.runs, tmp)
+            print("{:<20} {:>10.0f} {:>10.0f} {:>10}".format(name, fastest, median, budget))
+            if median - baseline > budget:
+                over.append(name)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    print("Interpreter startup of {:.0f} ms is not counted against budgets".format(baseline))
+
+    if args.check and over:
+        print("Over budget: " + ', '.join(over))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
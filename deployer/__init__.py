@@ -1,32 +1,28 @@
 #!/usr/bin/env python
 import argparse
 import json
+import glob
 import os
-from botocore.exceptions import ClientError
-from deployer.stack import Stack
-from deployer.s3_sync import s3_sync
-from deployer.lambda_prep import LambdaPrep
+import shutil
 from deployer.logger import logging, logger, console_logger
-from deployer.stack_sets import StackSet
-from distutils.dir_util import copy_tree
 from collections import defaultdict
 from deployer.logger import update_colors
-from deployer.configuration import Config
-from deployer.cloudtools_bucket import CloudtoolsBucket
-from boto3.session import Session
+from deployer.exceptions import ConfigError
 
-import ruamel.yaml
 import sys, traceback
 
+# boto3 and the modules using it are imported where they are first
+# needed, so `-v`, `-h` and `--init` do not pay for them.
+
 __version__ = '0.0.0'
 
 
 def main():
     # Build arguement parser
     parser = argparse.ArgumentParser(description='Deploy CloudFormation Templates')
-    parser.add_argument("-c", "--config", help="Path to config file.")
+    parser.add_argument("-c", "--config", action='append', nargs='+', help="Path to config file. Accepts several files or glob patterns.")
     parser.add_argument("-s", "--stack", help="Stack Name.")
-    parser.add_argument("-x", "--execute", help="Execute ( create | update | delete | upsert | sync | change ) of stack.")
+    parser.add_argument("-x", "--execute", help="Execute ( create | update | delete | upsert | sync | change | describe | serve | watch ) of stack.")
     parser.add_argument("-P", "--param", action='append', help='An override for a parameter')
     parser.add_argument("-p", "--profile", help="Profile.",default=None)
     parser.add_argument("-t", "--change-set-name", help="Change Set Name.")
@@ -42,8 +38,29 @@ def main():
     parser.add_argument("-T", "--timeout", type=int, help='Stack create timeout in minutes')
     parser.add_argument('--init', default=None, const='.', nargs='?', help='Initialize a skeleton directory')
     parser.add_argument("--disable-color", help='Disables color output', action='store_true', dest='no_color')
+    parser.add_argument("--force", help='Update stacks even when nothing changed since their last deploy', action='store_true', dest='force')
+    parser.add_argument("--jobs", type=int, default=1, help='Number of stacks to run concurrently when running more than one stack')
+    parser.add_argument("--with-dependencies", help='Also run every stack the selected stack depends on', action='store_true', dest='with_dependencies')
+    parser.add_argument("--with-dependents", help='Also run every stack that depends on the selected stack', action='store_true', dest='with_dependents')
+    parser.add_argument("--resume", help='Skip stacks that completed in the previous run of the same config and release', action='store_true', dest='resume')
+    parser.add_argument("--shard", help='Only run shard K of N of the dependency graph, in the form K/N')
+    parser.add_argument("--shard-markers", help='Where shards share completion markers: s3://bucket/prefix or a local directory (default: the cloudtools bucket)', dest='shard_markers')
+    parser.add_argument("--run-id", help='Unique identifier of the run, shared by all of its shards', dest='run_id')
+    parser.add_argument("--shard-timeout", type=int, default=180, help='Minutes to wait for a stack on another shard before failing (default: 180)', dest='shard_timeout')
+    parser.add_argument("--listen", default='127.0.0.1:8080', help='Address the service listens on with -x serve (default: 127.0.0.1:8080). Addresses other than loopback require DEPLOYER_SERVICE_TOKEN')
+    parser.add_argument("--socket", help='Unix socket the service listens on with -x serve, instead of --listen')
+    parser.add_argument("--watch-interval", type=float, default=2, dest='watch_interval', help='Seconds between checks for changed files with -x watch (default: 2)')
+    parser.add_argument("--watch-change-set", help="Print a preview change set with -x watch when the stack's template changes", action='store_true', dest='watch_change_set')
+    parser.add_argument("--plan", help='Print the deployment levels and critical path without deploying', action='store_true', dest='plan')
+    parser.add_argument("--config-jobs", type=int, default=1, dest='config_jobs', help='Number of configs to run concurrently when several are given')
+    parser.add_argument("--max-pool-connections", type=int, dest='max_pool_connections', help='Connections each shared AWS client keeps open (default: the number of concurrent jobs, at least 10)')
+    parser.add_argument("--keep-going", help='Continue independent stacks after a failure when running more than one stack', action='store_true', dest='keep_going')
+    parser.add_argument("--state-dir", dest='state_dir', help='Directory for caches, config indexes and run journals (default: DEPLOYER_STATE_DIR or ~/.cache/deployer)')
 
     args = parser.parse_args()
+    if args.state_dir:
+        from deployer import state
+        state.directory = args.state_dir
 
 
     # Load colors into logger
@@ -65,15 +82,22 @@ def main():
     if args.init is not None:
         script_dir = os.path.dirname(__file__)
         skel_dir = os.path.join(script_dir, 'skel')
-        copy_tree(skel_dir, args.init)
+        try:
+            shutil.copytree(skel_dir, args.init, dirs_exist_ok=True)
+        except TypeError:
+            # Python before 3.8, distutils is slow to import
+            from distutils.dir_util import copy_tree
+            copy_tree(skel_dir, args.init)
         exit(0)
 
     # Validate arguements and parameters
     options_broken = False
     params = {}
     if not args.config:
-        args.config = 'config.yml'
-    if not args.all:
+        args.config = ['config.yml']
+    else:
+        args.config = [x for group in args.config for x in group]
+    if not args.all and not args.plan and args.execute != 'serve':
         if not args.execute:
             print(colors['warning'] + "Must Specify execute flag!" + colors['reset'])
             options_broken = True
@@ -88,6 +112,21 @@ def main():
             else:
                 print(colors['warning'] + "Invalid format for parameter '{}'".format(param) + colors['reset'])
                 options_broken = True
+    if (args.with_dependencies or args.with_dependents) and args.all:
+        print(colors['warning'] + "Dependency selection requires a single stack, not --all!" + colors['reset'])
+        options_broken = True
+    if args.resume and not (args.all or args.with_dependencies or args.with_dependents):
+        print(colors['warning'] + "Resume requires --all or a dependency selection!" + colors['reset'])
+        options_broken = True
+    if args.shard and not (args.all and (args.run_id or args.plan)):
+        print(colors['warning'] + "Sharding requires --all and --run-id!" + colors['reset'])
+        options_broken = True
+    if args.execute == 'watch' and (args.all or len(args.config) != 1):
+        print(colors['warning'] + "Watch requires a single stack and config!" + colors['reset'])
+        options_broken = True
+    if args.jobs < 1 or args.config_jobs < 1:
+        print(colors['warning'] + "Jobs must be at least 1!" + colors['reset'])
+        options_broken = True
 
     # Print help output
     if options_broken:
@@ -96,130 +135,215 @@ def main():
 
     if args.debug:
         console_logger.setLevel(logging.DEBUG)
+    if args.jobs > 1 or args.config_jobs > 1:
+        # Prefix messages with the stack that logged them
+        console_logger.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(threadName)s - %(message)s'))
     if args.execute == 'describe':
         console_logger.setLevel(logging.ERROR)
 
     try:
-        # Read Environment Config
-        with open(args.config) as f:
-            config = ruamel.yaml.safe_load(f)
-
-        # Load stacks into queue
-        stackQueue = []
-        if not args.all:
-            stackQueue = [args.stack]
-        else:
-            for stack in config.items():
-                if stack[0] != "global":
-                    stackQueue = find_deploy_path(config, stack[0], stackQueue)
-
-        # Create or update all Environments
-        for stack in stackQueue:
-            if stack != 'global' and (args.all or stack == args.stack):
-
-                logger.info("Running " + colors['underline'] + str(args.execute) + colors['reset'] + " on stack: " + colors['stack'] + stack + colors['reset'])
-
-                # Build lambdas on `-z`
-                if args.zip_lambdas:
-                    logger.info("Building lambdas for stack: " + stack)
-                    LambdaPrep(args.config, args.stack).zip_lambdas()
-
-                # Create deployer config object
-                config_object = Config(args.config, stack)
-
-                # AWS Session object
-                session = Session(profile_name=args.profile, region_name=config_object.get_config_att('region'))
-
-                # Pass arguements as dictionary
-                arguements = {
-                    'disable_rollback' : args.rollback,
-                    'print_events' : args.events,
-                    'timeout' : args.timeout,
-                    'colors' : colors,
-                    'params' : params
-                }
-                
-                # S3 bucket to sync to
-                bucket = CloudtoolsBucket(session, config_object.get_config_att('sync_dest_bucket', None))
-
-                # Check whether stack is a stack set or not and assign corresponding object
-                if(len(config_object.get_config_att('regions', [])) > 0 or len(config_object.get_config_att('accounts', [])) > 0):
-                    env_stack = StackSet(session, stack, config_object, bucket, arguements)
-                else:
-                    if args.timeout and args.execute not in ['create', 'upsert']:
-                        logger.warning("Timeout specified but action is not 'create'. Timeout will be ignored.")
-                    env_stack = Stack(session, stack, config_object, bucket, arguements)
+        from deployer.context import RunContext
+        from deployer.executor import DeploymentExecutor
+        context = RunContext(args.profile, max_pool_connections=args.max_pool_connections or max(10, args.jobs * args.config_jobs))
 
-                try:
+        # Keep sessions and configs warm and run jobs sent over HTTP
+        if args.execute == 'serve':
+            from deployer.service import DeployerService, serve
+            service = DeployerService(context, args.jobs, {
+                'params' : params,
+                'disable_rollback' : args.rollback,
+                'print_events' : args.events,
+                'timeout' : args.timeout,
+                'force' : args.force,
+                'assume_valid' : args.assume_valid,
+                'debug' : args.debug,
+                'colors' : colors
+            }, os.environ.get('DEPLOYER_SERVICE_TOKEN'))
+            serve(service, args.listen, args.socket)
+            return
 
-                    # Sync files to S3
-                    if args.sync or args.execute == 'sync':
-                        s3_sync(session, config_object, bucket, args.assume_valid, args.debug)
-
-                    # Check which action to execute
-                    if args.execute == "describe":
-                        print(json.dumps(env_stack.describe(),
-                                        sort_keys=True,
-                                        indent=4,
-                                        separators=(',', ': '),
-                                        default=lambda x: x.isoformat()))
-                    elif args.execute == 'change':
-                        env_stack.get_change_set(args.change_set_name, args.change_set_description, 'UPDATE')
-                    else:
-                        # Check stack object for supported action
-                        operation = getattr(env_stack, (args.execute + "_stack"), None)
-                        if callable(operation):
-                            operation()
-                        else:
-                            logger.warning(args.execute + " is not a valid method!")
-
-                except ClientError as e:
-                        if not args.all:
-                            raise e
-                        elif e.response['Error']['Code'] == 'AlreadyExistsException':
-                            logger.info("Stack, " + stack + ", already exists.")
-                        else:
-                            raise e
+        configs = find_configs(args.config)
+        if len(configs) == 1:
+            run_config(configs[0], args, colors, params, context)
+        else:
+            # Every config is independent, so they only share the context
+            executor = DeploymentExecutor(dict((x, []) for x in configs), args.config_jobs, args.keep_going)
+            executor.run(configs, lambda x: run_config(x, args, colors, params, context, "# " + x))
     except (Exception) as e:
         logger.error(e)
         if args.debug:
             tb = sys.exc_info()[2]
             traceback.print_tb(tb)
-        exit(1)
+        exit(getattr(e, 'exit_code', 1))
+    except KeyboardInterrupt:
+        # Workers may still be polling stacks that were cancelled, exit
+        # without joining them
+        logging.shutdown()
+        sys.stdout.flush()
+        os._exit(1)
+
+def run_config(config_file, args, colors, params, context, label=None):
+    from botocore.exceptions import ClientError
+    from deployer.api import Deployer, ACTIONS
+    from deployer.executor import DeploymentExecutor, SUCCEEDED, FAILED, SKIPPED
+    from deployer.journal import RunJournal, config_fingerprint, current_release
+    from deployer.shard import parse_shard, assign_shards, ShardCoordinator
+
+    deployer = Deployer(config_file,
+        context=context,
+        params=params,
+        disable_rollback=args.rollback,
+        print_events=args.events,
+        timeout=args.timeout,
+        force=args.force,
+        assume_valid=args.assume_valid,
+        debug=args.debug,
+        colors=colors)
+    config = deployer.config
+
+    # Build the dependency graph once, narrowed down to the selected stack
+    # and its relatives. A single stack never needs it, so a broken stack
+    # elsewhere in the config does not stop it from running.
+    batch = args.all or args.with_dependencies or args.with_dependents
+    plan = None
+    if batch or args.plan:
+        if not args.all and args.stack:
+            plan = deployer.plan(args.stack, args.with_dependencies, args.with_dependents)
+        else:
+            plan = deployer.plan()
+        if args.execute == 'delete':
+            # Tear down dependents before the stacks they depend on
+            plan = plan.reverse()
+
+    # Sync changed files until interrupted on `-x watch`
+    if args.execute == 'watch' and not args.plan:
+        from deployer.watch import Watcher
+        Watcher(deployer, args.stack, args.watch_interval, args.watch_change_set).start()
+        return
+
+    # Print the deployment plan on `--plan` without touching AWS
+    if args.plan:
+        if label:
+            print(label)
+        print(plan.format())
+        if args.shard:
+            shard, count = parse_shard(args.shard)
+            assignments = assign_shards(plan, count)
+            print("Shard {}: {}".format(args.shard, ', '.join(x for x in plan.order if assignments[x] == shard)))
+        return
+
+    def run_stack(stack):
+        logger.info("Running " + colors['underline'] + str(args.execute) + colors['reset'] + " on stack: " + colors['stack'] + stack + colors['reset'])
+
+        # Build lambdas on `-z`
+        if args.zip_lambdas:
+            deployer.zip_lambdas(stack)
+
+        if args.timeout and args.execute not in ['create', 'upsert']:
+            logger.warning("Timeout specified but action is not 'create'. Timeout will be ignored.")
+
+        try:
+
+            # Sync files to S3
+            if args.sync or args.execute == 'sync':
+                deployer.sync(stack)
+
+            # Check which action to execute
+            if args.execute == "describe":
+                print(json.dumps(deployer.describe(stack),
+                                sort_keys=True,
+                                indent=4,
+                                separators=(',', ': '),
+                                default=lambda x: x.isoformat()))
+            elif args.execute == 'change':
+                deployer.change_set(stack, args.change_set_name, args.change_set_description)
+            elif args.execute in ACTIONS:
+                deployer.deploy(stack, args.execute)
+            elif args.execute != 'sync':
+                logger.warning(str(args.execute) + " is not a valid method!")
+
+        except ClientError as e:
+                if not batch:
+                    raise e
+                elif e.response['Error']['Code'] == 'AlreadyExistsException':
+                    logger.info("Stack, " + stack + ", already exists.")
+                else:
+                    raise e
+
+    # Create or update all Environments
+    if not batch:
+        run_stack(args.stack)
+    else:
+        # Record every stack so a failed run can be resumed
+        journal = RunJournal(config_file, current_release(config), resume=args.resume)
+
+        def run_journaled(stack):
+            fingerprint = config_fingerprint(config, stack, args.execute, params)
+            if journal.completed(stack, fingerprint):
+                logger.info("Stack " + stack + " already completed in a previous run, skipping.")
+                return
+            try:
+                run_stack(stack)
+            except BaseException:
+                journal.record(stack, FAILED, fingerprint)
+                raise
+            journal.record(stack, SUCCEEDED, fingerprint)
+
+        executor = DeploymentExecutor(plan.graph, args.jobs, args.keep_going)
+        if not args.shard:
+            executor.run(plan.order, run_journaled)
+        else:
+            # Only run the stacks owned by this shard, waiting on markers
+            # for the stacks they depend on from other shards
+            shard, count = parse_shard(args.shard)
+            assignments = assign_shards(plan, count)
+            owned = [x for x in plan.order if assignments[x] == shard]
+            foreign = set(edge for x in owned for edge in plan.graph[x] if assignments[edge] != shard)
+            coordinator = ShardCoordinator(get_marker_store(args, config, context), args.run_id, timeout=args.shard_timeout * 60)
+            logger.info("Shard {} owns {} of {} stacks".format(args.shard, len(owned), len(plan.order)))
+
+            def run_shard(stack):
+                try:
+                    run_journaled(stack)
+                except BaseException:
+                    coordinator.publish(stack, FAILED)
+                    raise
+                coordinator.publish(stack, SUCCEEDED)
+
+            try:
+                # Stacks of other shards are polled without taking a job
+                executor.run([x for x in plan.order if x in foreign or assignments[x] == shard], run_shard,
+                             dict((x, coordinator.check) for x in foreign), coordinator.interval)
+            finally:
+                for stack in owned:
+                    if executor.results.get(stack, SKIPPED) == SKIPPED:
+                        coordinator.publish(stack, SKIPPED)
+
+def find_configs(patterns):
+    # Expand every `-c` value, which may be a glob, into a list of files
+    configs = []
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            matches = sorted(glob.glob(pattern))
+            if not matches:
+                raise ConfigError("No config files match '{}'.".format(pattern))
+        else:
+            matches = [pattern]
+        configs += [x for x in matches if x not in configs]
+    return configs
 
-def find_deploy_path(stackConfig, checkStack, resolved = []):
-    #Generate depedency graph
-    graph = {}
-    for stack in stackConfig.items():
-        if stack[0] != "global":
-            edges = []
-            if 'lookup_parameters' in stack[1]:
-                for param in stack[1]['lookup_parameters']:
-                    edge = stack[1]['lookup_parameters'][param]
-                    if edge['Stack'] not in edges:
-                        edges.append(edge['Stack'])
-            if 'depends_on' in stack[1]:
-                for edge in stack[1]['depends_on']:
-                    if edge not in edges:
-                        edges.append(edge)
-            graph[stack[0]] = edges
-
-    #Find dependency order
-    resolve_dependency(graph, checkStack, resolved)
-    return resolved
-
-def resolve_dependency(graph, node, resolved, seen = []):
-    seen.append(node)
-    for edge in graph[node]:
-        if edge not in resolved:
-            #If node has already been seen, it's a circular dependency
-            if edge in seen:
-                raise Exception("Circular dependency detected between stacks %s and %s." % (node, edge))
-            #Check edge for dependencies
-            resolve_dependency(graph, edge, resolved, seen)
-    if node not in resolved:
-        resolved.append(node)
+def get_marker_store(args, config, context):
+    from deployer.shard import FileMarkerStore, S3MarkerStore
+    location = args.shard_markers
+    if location and not location.startswith('s3://'):
+        return FileMarkerStore(location)
 
+    session = context.session((config.get('global') or {}).get('region'))
+    if location:
+        bucket, _, prefix = location[len('s3://'):].partition('/')
+        return S3MarkerStore(session.client('s3'), bucket, prefix)
+    bucket = context.bucket(session, (config.get('global') or {}).get('sync_dest_bucket'))
+    return S3MarkerStore(session.client('s3'), bucket.name)
 
 if __name__ == '__main__':
     try: main()
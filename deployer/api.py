@@ -0,0 +1,160 @@
+from collections import defaultdict, OrderedDict
+
+from deployer.configuration import Config, load_config
+from deployer.context import RunContext
+from deployer.exceptions import ConfigError
+from deployer.executor import DeploymentExecutor
+from deployer.logger import logger
+from deployer.plan import DeploymentPlan
+
+
+ACTIONS = ['create', 'update', 'upsert', 'delete']
+
+
+class Deployer(object):
+    """Library interface to the stacks of one deployer config file.
+
+    Nothing here parses arguments or exits the process: failures are raised as
+    subclasses of ``deployer.exceptions.DeployerError`` or botocore's
+    ``ClientError``. Pass a ``RunContext`` to share sessions and caches between
+    several ``Deployer`` objects, or a ``session_factory`` taking a profile and
+    a region to inject your own boto3 sessions. ``outputs`` is the
+    ``OutputCache`` lookup_parameters are resolved with, the context's by
+    default.
+
+        deployer = Deployer('config/dev-us-east-1.yml', profile='dev')
+        deployer.sync('Network')
+        deployer.deploy('Network')
+        print(deployer.describe('Network')['StackStatus'])
+    """
+
+    def __init__(self, config_file, profile=None, context=None, session_factory=None, params=None,
+                 disable_rollback=False, print_events=False, timeout=None, force=False,
+                 assume_valid=False, debug=False, colors=None, outputs=None):
+        self.config_file = config_file
+        self.context = context or RunContext(profile, session_factory)
+        self.params = params or {}
+        self.assume_valid = assume_valid
+        self.debug = debug
+        self.colors = colors or defaultdict(lambda: '')
+        self.arguements = {
+            'disable_rollback' : disable_rollback,
+            'print_events' : print_events,
+            'timeout' : timeout,
+            'colors' : self.colors,
+            'params' : self.params,
+            'force' : force,
+            'outputs' : outputs or self.context.outputs
+        }
+        self.source = load_config(config_file)
+        self.config = self.source.data
+
+    def plan(self, stack=None, dependencies=False, dependents=False):
+        # Dependency plan of every stack, or of one stack and its relatives
+        plan = DeploymentPlan(None, self.source.graph())
+        if stack is None:
+            return plan
+        stacks = [stack]
+        if dependencies:
+            stacks += plan.dependencies(stack)
+        if dependents:
+            stacks += plan.dependents(stack)
+        return plan.subset(stacks)
+
+    def config_object(self, stack, region=None):
+        if stack == 'global' or stack not in self.config:
+            raise ConfigError("Stack '{}' is not defined in config '{}'.".format(stack, self.config_file))
+        return Config(self.config_file, stack, {'region': region} if region else None)
+
+    def session(self, config_object):
+        return self.context.session(config_object.get_config_att('region'), role_arn=config_object.get_config_att('role_arn'))
+
+    def bucket(self, config_object, session):
+        # `{region}` in sync_dest_bucket names a bucket per region
+        override = config_object.get_config_att('sync_dest_bucket', None)
+        if override:
+            override = override.replace('{region}', session.region_name)
+        return self.context.bucket(session, override)
+
+    def stack(self, stack, region=None, with_bucket=True):
+        # Stack or StackSet object for a stack in the config. Stacks that
+        # are only read do not need the cloudtools bucket.
+        from deployer.stack import Stack
+        from deployer.stack_sets import StackSet
+        config_object = self.config_object(stack, region)
+        session = self.session(config_object)
+        if(len(config_object.get_config_att('regions', [])) > 0 or len(config_object.get_config_att('accounts', [])) > 0):
+            return StackSet(session, stack, config_object, self.bucket(config_object, session), self.arguements)
+        bucket = self.bucket(config_object, session) if with_bucket else None
+        return Stack(session, stack, config_object, bucket, self.arguements)
+
+    def regions(self, stack):
+        # Regions a plain stack is deployed to with `deploy_regions`, or None
+        config_object = self.config_object(stack)
+        regions = config_object.get_config_att('deploy_regions')
+        if regions and (config_object.get_config_att('regions') or config_object.get_config_att('accounts')):
+            raise ConfigError("Stack '{}' cannot set both deploy_regions and StackSet regions or accounts.".format(stack))
+        if regions is not None and not isinstance(regions, list):
+            raise ConfigError("Attribute 'deploy_regions' must be a list.")
+        return regions or None
+
+    def fan_out(self, stack, worker):
+        # Call worker(region) for every region of the stack, at most
+        # region_jobs at a time. Results are keyed by region.
+        regions = self.regions(stack)
+        if not regions:
+            return worker(None)
+        jobs = self.config_object(stack).get_config_att('region_jobs', len(regions))
+        labels = OrderedDict(("{}:{}".format(stack, x), x) for x in regions)
+        results = {}
+        def run(label):
+            logger.info("Running stack {} in region {}".format(stack, labels[label]))
+            results[labels[label]] = worker(labels[label])
+        DeploymentExecutor(dict((x, []) for x in labels), jobs, keep_going=True).run(labels, run)
+        return results
+
+    def zip_lambdas(self, stack):
+        from deployer.lambda_prep import LambdaPrep
+        logger.info("Building lambdas for stack: " + stack)
+        LambdaPrep(self.config_file, stack).zip_lambdas()
+
+    def sync(self, stack):
+        # Validate and upload the stack's sync_dirs to its cloudtools bucket
+        return self.fan_out(stack, lambda region: self.syncer(stack, region, auto_sync=True))
+
+    def syncer(self, stack, region=None, auto_sync=False):
+        # s3_sync object for a stack, only syncing with auto_sync
+        from deployer.s3_sync import s3_sync
+        config_object = self.config_object(stack, region)
+        session = self.session(config_object)
+        bucket = self.bucket(config_object, session)
+        return s3_sync(session, config_object, bucket, self.assume_valid, self.debug, auto_sync)
+
+    def deploy(self, stack, action='upsert'):
+        # Run create, update, upsert or delete on a stack
+        if action not in ACTIONS:
+            raise ValueError(action + " is not a valid method!")
+        def deploy(region):
+            env_stack = self.stack(stack, region)
+            getattr(env_stack, action + "_stack")()
+            return env_stack
+        return self.fan_out(stack, deploy)
+
+    def change_set(self, stack, name, description):
+        def change_set(region):
+            env_stack = self.stack(stack, region)
+            env_stack.get_change_set(name, description, 'UPDATE')
+            return env_stack
+        return self.fan_out(stack, change_set)
+
+    def describe(self, stack):
+        return self.fan_out(stack, lambda region: self.stack(stack, region, with_bucket=False).describe())
+
+    def run(self, action='upsert', plan=None, jobs=1, keep_going=False):
+        # Run an action on every stack of a plan in dependency order, or in
+        # reverse dependency order for delete
+        plan = plan or self.plan()
+        if action == 'delete':
+            plan = plan.reverse()
+        executor = DeploymentExecutor(plan.graph, jobs, keep_going)
+        return executor.run(plan.order, lambda stack: self.deploy(stack, action))
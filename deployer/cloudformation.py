@@ -1,7 +1,9 @@
 #!/usr/bin/env python
-import git
 from abc import ABCMeta, abstractmethod
+from deployer.exceptions import AccountValidationError
+from deployer.identity import caller_identity
 from deployer.logger import logger
+from deployer.repository import get_repository
 
 # Maybe needed
 import ruamel.yaml
@@ -53,18 +55,10 @@ class AbstractCloudFormation(object):
         pass
 
     def get_repository(self, base):
-        try:
-            return git.Repo(base, search_parent_directories=True)
-        except git.exc.InvalidGitRepositoryError:
-            return None
+        return get_repository(base)
 
     def get_repository_origin(self, repository):
-        try:
-            origin = repository.remotes.origin.url
-            return origin.split('@', 1)[-1] if origin else None
-        except (StopIteration, ValueError):
-            return None
-        return None
+        return repository.origin
 
     def get_template_body(self, bucket, template):
         if not bucket:
@@ -79,8 +73,7 @@ class AbstractCloudFormation(object):
 
     def validate_account(self, session, config):
         # Check if account in config matches the authorized account
-        current = session.client('sts').get_caller_identity().get('Account', None)
+        current = caller_identity(session).get('Account', None)
         configured = config.get_config_att('account', None)
         if configured is not None and current != configured:
-            logger.error("Account validation failed. Expected '{}' but received '{}'".format(configured, current))
-            exit(1)
+            raise AccountValidationError("Account validation failed. Expected '{}' but received '{}'".format(configured, current))
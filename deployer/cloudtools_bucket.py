@@ -1,8 +1,11 @@
-import boto3
+import json, os, threading, time
+
 from botocore.exceptions import ClientError
 from parse import parse
 
+from deployer.identity import caller_identity
 from deployer.logger import logger
+from deployer.state import state_path
 
 # Allow Python 2.x
 try:
@@ -11,9 +14,16 @@ except NameError:
     pass
 
 class CloudtoolsBucket():
+    # Names found in SSM are kept on disk for a day, per account and region
+    cache_file = None
+    cache_ttl = 86400
+    cache_lock = threading.Lock()
+
     def __init__(self, session, override_bucket = None, create_bucket = True):
 
         self.override_bucket = override_bucket
+        self._name = None
+        self.cached = False
 
         # Create boto3 objects
         self.session = session
@@ -23,35 +33,96 @@ class CloudtoolsBucket():
         self.s3 = session.resource('s3').Bucket(self.name)
 
         # Create bucket if bucket does not exist
-        if not self.bucket_exists:
-            if create_bucket:
-                self.s3.create()
+        exists = self.bucket_exists
+        if not exists and self.cached and self.forget():
+            self.s3 = session.resource('s3').Bucket(self.name)
+            exists = self.bucket_exists
+        if not exists and create_bucket:
+            self.s3.create()
 
     @property
     def name(self):
+        # Resolved once, every file synced reads it
+        if self._name is None:
+            self._name = self.resolve_name()
+        return self._name
+
+    def resolve_name(self):
+        self.cached = False
         if self.override_bucket:
             return self.override_bucket
 
+        account = caller_identity(self.session).get('Account')
+        key = "{}:{}".format(account, self.session.region_name)
+        entry = self.load_cache().get(key)
+        if entry and entry['expires'] > time.time():
+            logger.debug("Using cached cloudtools bucket " + entry['name'])
+            self.cached = True
+            return entry['name']
+
         # If bucket name not set, search ssm for bucket
-        parameter_name = '/global/' + self.session.region_name
+        name = None
         for parameter_name in ['/' + self.session.region_name,'/global']:
             try:
                 result = self.ssm.get_parameter(Name=parameter_name + "/buckets/cloudtools/name")
-                return result['Parameter']['Value']
+                name = result['Parameter']['Value']
+                break
             except ClientError as e:
-                if e.response['Error']['Code'] == 'ParameterNotFound':
-                    account = self.sts.get_caller_identity().get('Account')
-                else:
+                if e.response['Error']['Code'] != 'ParameterNotFound':
                     raise e
         # If no bucket is found, use default bucket
-        return "cloudtools-" + str(account) + "-" + self.session.region_name
+        name = name or "cloudtools-" + str(account) + "-" + self.session.region_name
+        self.save_cache(key, name)
+        return name
+
+    def forget(self):
+        # Drop a cached name that no longer exists and resolve it again
+        account = caller_identity(self.session).get('Account')
+        self.save_cache("{}:{}".format(account, self.session.region_name), None)
+        stale = self._name
+        self._name = None
+        return self.name != stale
 
+    def cache_path(self):
+        return self.cache_file or state_path('cache', 'cloudtools-buckets.json')
+
+    def load_cache(self):
+        try:
+            with open(self.cache_path()) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def save_cache(self, key, name):
+        path = self.cache_path()
+        with self.cache_lock:
+            entries = self.load_cache()
+            if name:
+                entries[key] = {'name': name, 'expires': time.time() + self.cache_ttl}
+            else:
+                entries.pop(key, None)
+            try:
+                directory = os.path.dirname(path)
+                if directory and not os.path.isdir(directory):
+                    os.makedirs(directory)
+                temp = "{}.{}.tmp".format(path, os.getpid())
+                with open(temp, 'w') as f:
+                    json.dump(entries, f, indent=2, sort_keys=True)
+                os.replace(temp, path)
+            except (IOError, OSError) as e:
+                logger.debug("Unable to cache the cloudtools bucket name: {}".format(e))
 
     @property
     def bucket_exists(self):
-        if self.s3.creation_date:
+        # One HEAD request instead of listing every bucket in the account
+        try:
+            self.session.client('s3').head_bucket(Bucket=self.name)
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] in ['404', 'NoSuchBucket', 'NotFound']:
+                return False
+            # Forbidden still means the bucket exists
             return True
-        return False
 
     def construct_template_url(self, config, stack, release, template):
         alt = 'full_template_url'
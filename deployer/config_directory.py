@@ -0,0 +1,169 @@
+import hashlib, json, os, threading
+import ruamel.yaml
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+from deployer.discovery import TemplateIndex
+from deployer.exceptions import ConfigError
+from deployer.logger import logger
+from deployer.plan import DeploymentPlan
+from deployer.state import state_path
+
+
+def file_stat(path):
+    try:
+        stat = os.stat(path)
+        return [stat.st_mtime, stat.st_size]
+    except (TypeError, OSError):
+        return None
+
+
+class StackBlocks(Mapping):
+    """Read-only mapping of stack names to blocks, parsing files on access."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def __getitem__(self, name):
+        return self.directory.block(name)
+
+    def __contains__(self, name):
+        return name in self.directory.files
+
+    def __iter__(self):
+        return iter(self.directory.names())
+
+    def __len__(self):
+        return len(self.directory.files)
+
+
+class ConfigDirectory(object):
+    """A config split into ``global.yml`` and one file per stack.
+
+    Each ``<stack>.yml`` holds the block of the stack of the same name. Files
+    are only parsed when a stack is used, and again when they change on disk.
+    Stack names and dependency edges come from an index kept under
+    ``index`` in the state directory, so planning only parses the stacks whose file,
+    template or ``global.yml`` changed since the index was written.
+    """
+
+    extensions = ['.yml', '.yaml', '.json']
+    # Bumped when entries change shape, so older indexes are rebuilt
+    index_version = 2
+
+    def __init__(self, path, index_directory=None):
+        self.file_name = path
+        key = hashlib.sha256(os.path.abspath(path).encode('utf-8')).hexdigest()[:16]
+        self.index_file = os.path.join(index_directory or state_path('index'), key + '.json')
+        self.lock = threading.RLock()
+        self.files = {}
+        self.blocks = {}
+        self.views = {}
+        self.data = StackBlocks(self)
+        self.refresh()
+
+    def refresh(self):
+        # Find the stack files and forget blocks that changed since parsing
+        files = {}
+        try:
+            names = sorted(os.listdir(self.file_name))
+        except OSError as e:
+            raise ConfigError("Unable to read config '{}': {}".format(self.file_name, e))
+        for fname in names:
+            name, extension = os.path.splitext(fname)
+            if extension not in self.extensions or fname.startswith('.'):
+                continue
+            if name in files:
+                raise ConfigError("Stack '{}' is defined by more than one file in '{}'.".format(name, self.file_name))
+            files[name] = os.path.join(self.file_name, fname)
+
+        with self.lock:
+            self.files = files
+            for name in list(self.blocks):
+                if file_stat(files.get(name)) != self.blocks[name][0]:
+                    del self.blocks[name]
+                    self.views = {} if name == 'global' else dict((x, y) for x, y in self.views.items() if x != name)
+
+    def names(self):
+        # global first, then the stacks in file name order
+        return sorted(self.files, key=lambda x: (x != 'global', x))
+
+    def block(self, name):
+        with self.lock:
+            if name not in self.blocks:
+                if name not in self.files:
+                    raise KeyError(name)
+                path = self.files[name]
+                stat = file_stat(path)
+                try:
+                    with open(path) as f:
+                        block = ruamel.yaml.safe_load(f)
+                except (IOError, OSError) as e:
+                    raise ConfigError("Unable to read config '{}': {}".format(path, e))
+                if block is not None and not isinstance(block, dict):
+                    raise ConfigError("Config '{}' must be a mapping of attributes.".format(path))
+                logger.debug("Parsed config " + path)
+                self.blocks[name] = (stat, block or {})
+            return self.blocks[name][1]
+
+    def attributes(self, stack):
+        # The global block overlaid with the stack's own block
+        with self.lock:
+            if stack not in self.views:
+                view = dict(self.data.get('global') or {})
+                if stack in self.files:
+                    view.update(self.block(stack))
+                self.views[stack] = view
+            return self.views[stack]
+
+    def load_index(self):
+        try:
+            with open(self.index_file) as f:
+                index = json.load(f)
+            return index.get('stacks', {}) if index.get('version') == self.index_version else {}
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def save_index(self, entries):
+        directory = os.path.dirname(self.index_file)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        temp = self.index_file + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump({'version': self.index_version, 'stacks': entries}, f, indent=2, sort_keys=True)
+        os.replace(temp, self.index_file)
+
+    def index_entry(self, name):
+        config = {'global': self.data.get('global') or {}, name: self.block(name)}
+        index = TemplateIndex(config)
+        template = index.attributes(name).get('template')
+        return {
+            'stat': [file_stat(self.files.get('global')), file_stat(self.files[name]), file_stat(template)],
+            'template': template,
+            'edges': DeploymentPlan.stack_edges(config[name]),
+            'names': index.names(name)
+        }
+
+    def graph(self):
+        # Dependency graph from the index, refreshing only stale entries
+        index = self.load_index()
+        entries = {}
+        for name in self.names():
+            if name == 'global':
+                continue
+            entry = index.get(name)
+            stat = [file_stat(self.files.get('global')), file_stat(self.files[name]), file_stat(entry and entry['template'])]
+            if entry is None or entry['stat'] != stat:
+                entry = self.index_entry(name)
+            entries[name] = entry
+        if entries != index:
+            self.save_index(entries)
+
+        graph = dict((name, list(entry['edges'])) for name, entry in entries.items())
+        for name, edges in TemplateIndex.match(dict((x, y['names']) for x, y in entries.items())).items():
+            graph[name] += [edge for edge in edges if edge not in graph[name]]
+        DeploymentPlan.check_graph(graph)
+        return graph
@@ -1,15 +1,77 @@
 
+from deployer.config_directory import ConfigDirectory
+from deployer.exceptions import ConfigError
 from deployer.logger import logger
-from deployer.stack import Stack
-import ruamel.yaml, json, re
+from deployer.plan import DeploymentPlan
+import ruamel.yaml, json, os, re, threading
+
+class ConfigFile(object):
+    """A parsed config file and the merged attributes of each of its stacks.
+
+    Shared by everything that reads the same file, so the parsed data must
+    not be modified.
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        try:
+            with open(file_name) as f:
+                self.data = ruamel.yaml.safe_load(f) or {}
+        except (IOError, OSError) as e:
+            raise ConfigError("Unable to read config '{}': {}".format(file_name, e))
+        if not isinstance(self.data, dict):
+            raise ConfigError("Config '{}' must be a mapping of stacks.".format(file_name))
+        self.base = dict(self.data.get('global') or {})
+        self.views = {}
+        for stack, block in self.data.items():
+            view = dict(self.base)
+            view.update(block or {})
+            self.views[stack] = view
+
+    def attributes(self, stack):
+        # The global block overlaid with the stack's own block
+        return self.views.get(stack, self.base)
+
+    def graph(self):
+        return DeploymentPlan.build_graph(self.data)
+
+
+config_files = {}
+config_files_lock = threading.Lock()
+
+def load_config(file_name):
+    # Parse each config file once, and again only when it changes on disk.
+    # A directory holds one file per stack and is parsed a stack at a time.
+    if os.path.isdir(file_name):
+        key = os.path.abspath(file_name)
+        with config_files_lock:
+            if key not in config_files:
+                config_files[key] = (None, ConfigDirectory(file_name))
+            directory = config_files[key][1]
+        directory.refresh()
+        return directory
+    try:
+        stat = os.stat(file_name)
+    except (IOError, OSError) as e:
+        raise ConfigError("Unable to read config '{}': {}".format(file_name, e))
+    key = os.path.abspath(file_name)
+    with config_files_lock:
+        cached = config_files.get(key)
+        if cached is None or cached[0] != (stat.st_mtime, stat.st_size):
+            cached = ((stat.st_mtime, stat.st_size), ConfigFile(file_name))
+            config_files[key] = cached
+        return cached[1]
+
 
 class Config(object):
-    def __init__(self, file_name, master_stack):
+    def __init__(self, file_name, master_stack, overrides=None):
         self.file_name = file_name
-        self.config = self.get_config()
+        self.config_file = load_config(file_name)
+        self.config = self.config_file.data
         self.stack = master_stack
+        self.overrides = overrides or {}
 
-    def build_params(self, session, stack_name, release, params, temp_file):
+    def build_params(self, session, stack_name, release, params, temp_file, outputs=None):
         # create parameters from the config.yml file
         self.parameter_file = "%s-params.json" % stack_name
         expanded_params = []
@@ -33,12 +95,20 @@ class Config(object):
                     if not overwritten:
                         expanded_params.append({ "ParameterKey": param_key, "ParameterValue": param_xform })
             if 'lookup_parameters' in self.config.get(env, {}):
-                for param_key, lookup_struct in self.config[env]['lookup_parameters'].items():
-                    stack = Stack(session, lookup_struct['Stack'], self, None)
-                    stack.get_outputs()
-                    for output in stack.outputs:
-                        if output['OutputKey'] == lookup_struct['OutputKey']:
-                            expanded_params.append({ "ParameterKey": param_key, "ParameterValue": output['OutputValue'] })
+                if outputs is None:
+                    from deployer.outputs import OutputCache
+                    outputs = OutputCache()
+                lookups = self.config[env]['lookup_parameters']
+                lookups_by_stack, exports = {}, {}
+                for param_key, lookup_struct in lookups.items():
+                    if 'Export' in lookup_struct:
+                        exports[param_key] = lookup_struct['Export']
+                    else:
+                        stack = self.get_config_att('stack_name', required=True, stack=lookup_struct['Stack'])
+                        lookups_by_stack[param_key] = (stack, lookup_struct['OutputKey'])
+                values = outputs.resolve(session, lookups_by_stack, exports)
+                for param_key in lookups:
+                    expanded_params.append({ "ParameterKey": param_key, "ParameterValue": values[param_key] })
 
         # Remove overridden parameters and set them based on the override
         # provided. Explicit overrides take priority over anything in the
@@ -68,18 +138,16 @@ class Config(object):
         return return_params
 
     def get_config(self): 
-        with open(self.file_name) as f:
-            data = ruamel.yaml.safe_load(f)
-        return data
+        return load_config(self.file_name).data
 
     def get_config_att(self, key, default=None, required=False, stack=None):
         ## Default to the current stack if not otherwise specified
         if not stack:
             stack = self.stack
 
-        base = self.config.get('global', {}).get(key, None)
-        base = self.config.get(stack).get(key, base)
+        base = self.config_file.attributes(stack).get(key, None)
+        if stack == self.stack:
+            base = self.overrides.get(key, base)
         if required and base is None:
-            logger.error("Required attribute '{}' not found in config '{}'.".format(key, self.file_name))
-            exit(3)
+            raise ConfigError("Required attribute '{}' not found in config '{}'.".format(key, self.file_name))
         return base if base is not None else default
\ No newline at end of file
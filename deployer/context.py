@@ -0,0 +1,100 @@
+import threading
+
+from deployer.credentials import CredentialCache, shared_session
+
+
+class PooledSession(object):
+    """boto3 session that creates each client once and shares it.
+
+    boto3 clients are thread safe but sessions are not, so clients are
+    created under a lock and then used by every thread. Resources are not
+    thread safe and are still created for each caller. Anything else is
+    passed through to the wrapped session.
+    """
+
+    def __init__(self, session, config=None):
+        self.session = session
+        self.config = config
+        self.lock = threading.Lock()
+        self.clients = {}
+
+    def client(self, service, **kwargs):
+        if kwargs:
+            # Custom endpoints or configs are not shared
+            with self.lock:
+                return self.session.client(service, **kwargs)
+        with self.lock:
+            if service not in self.clients:
+                self.clients[service] = self.session.client(service, config=self.config)
+            return self.clients[service]
+
+    def resource(self, service, **kwargs):
+        kwargs.setdefault('config', self.config)
+        with self.lock:
+            return self.session.resource(service, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+
+class RunContext(object):
+    """State shared by every config and stack deployed by one process.
+
+    Sessions, their clients and cloudtools buckets are created once per
+    profile and region and reused, so running many configs or stacks does
+    not repeat credential loading, endpoint resolution and bucket resolution
+    for each of them. Stack outputs read by lookup_parameters are cached for
+    the life of the context. Credentials come from a ``CredentialCache`` shared by
+    every session, so a role is assumed once per role and region rather than
+    once per session. Clients keep up to ``max_pool_connections`` connections
+    open, which should be at least the number of stacks run concurrently.
+    """
+
+    def __init__(self, profile=None, session_factory=None, max_pool_connections=None):
+        self.profile = profile
+        self.credentials = CredentialCache()
+        self.session_factory = session_factory or self.credentials.session
+        self.max_pool_connections = max_pool_connections
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.buckets = {}
+        self._outputs = None
+
+    def session(self, region, profile=None, role_arn=None):
+        key = (profile or self.profile, region, role_arn)
+        # Roles are assumed with the profile's own session in that region
+        source = self.session(region, profile) if role_arn else None
+        with self.lock:
+            if key not in self.sessions:
+                if role_arn:
+                    session = shared_session(key[0], region, self.credentials.role(source, role_arn, region))
+                else:
+                    session = self.session_factory(key[0], region)
+                self.sessions[key] = PooledSession(session, self.client_config())
+            return self.sessions[key]
+
+    def client_config(self):
+        if not self.max_pool_connections:
+            return None
+        from botocore.config import Config
+        return Config(max_pool_connections=self.max_pool_connections)
+
+    def client(self, service, region, profile=None):
+        return self.session(region, profile).client(service)
+
+    @property
+    def outputs(self):
+        # Stack outputs and exports read by lookup_parameters in this run
+        from deployer.outputs import OutputCache
+        with self.lock:
+            if self._outputs is None:
+                self._outputs = OutputCache()
+            return self._outputs
+
+    def bucket(self, session, override=None):
+        from deployer.cloudtools_bucket import CloudtoolsBucket
+        key = (id(session), override)
+        with self.lock:
+            if key not in self.buckets:
+                self.buckets[key] = CloudtoolsBucket(session, override)
+            return self.buckets[key]
@@ -0,0 +1,71 @@
+import threading
+
+
+class SharedCredentialProvider(object):
+    """botocore credential provider handing out credentials resolved elsewhere."""
+    METHOD = 'deployer-shared'
+    CANONICAL_NAME = None
+
+    def __init__(self, credentials):
+        self.credentials = credentials
+
+    def load(self):
+        return self.credentials
+
+
+def shared_session(profile, region, credentials):
+    # boto3 session using credentials shared with other sessions. The
+    # resolver only holds the shared provider, the providers botocore would
+    # otherwise chain depend on whether a profile is set.
+    import botocore.session
+    from boto3.session import Session
+    from botocore.credentials import CredentialResolver
+    botocore_session = botocore.session.Session(profile=profile)
+    botocore_session.register_component('credential_provider', CredentialResolver([SharedCredentialProvider(credentials)]))
+    return Session(botocore_session=botocore_session, region_name=region)
+
+
+class CredentialCache(object):
+    """Credentials shared by every session of a run.
+
+    A profile's credentials are resolved once whatever the region, so an
+    assume-role profile calls AssumeRole once instead of once per session.
+    A stack's ``role_arn`` is assumed once per role and region. Both are
+    botocore refreshable credentials, which renew ahead of expiry under
+    their own lock, so worker threads can share them.
+    """
+
+    def __init__(self, session_name='deployer'):
+        self.session_name = session_name
+        self.lock = threading.Lock()
+        self.profiles = {}
+        self.roles = {}
+
+    def session(self, profile, region):
+        from boto3.session import Session
+        with self.lock:
+            credentials = self.profiles.get(profile)
+        if credentials is not None:
+            return shared_session(profile, region, credentials)
+        session = Session(profile_name=profile, region_name=region)
+        with self.lock:
+            self.profiles.setdefault(profile, session.get_credentials())
+        return session
+
+    def role(self, source, role_arn, region):
+        # Deferred, so nothing calls STS until a client needs credentials
+        from botocore.credentials import DeferredRefreshableCredentials
+        key = (role_arn, region)
+        with self.lock:
+            if key not in self.roles:
+                sts = source.client('sts')
+                def refresh():
+                    credentials = sts.assume_role(RoleArn=role_arn, RoleSessionName=self.session_name)['Credentials']
+                    return {
+                        'access_key': credentials['AccessKeyId'],
+                        'secret_key': credentials['SecretAccessKey'],
+                        'token': credentials['SessionToken'],
+                        'expiry_time': credentials['Expiration'].isoformat()
+                    }
+                self.roles[key] = DeferredRefreshableCredentials(refresh, 'assume-role')
+            return self.roles[key]
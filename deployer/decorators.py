@@ -1,5 +1,5 @@
 import time
-from functools import wraps
+from functools import update_wrapper, wraps
 
 
 def retry(ExceptionToCheck, tries=4, delay=3, backoff=2, logger=None):
@@ -41,3 +41,21 @@ def retry(ExceptionToCheck, tries=4, delay=3, backoff=2, logger=None):
         return f_retry  # true decorator
 
     return deco_retry
+
+
+class lazy_property(object):
+    """Property computed on first access and then cached on the instance.
+
+    Assigning the attribute replaces the cached value, and deleting it makes
+    the next access compute it again.
+    """
+    def __init__(self, f):
+        self.f = f
+        update_wrapper(self, f)
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = self.f(instance)
+        instance.__dict__[self.f.__name__] = value
+        return value
@@ -0,0 +1,165 @@
+import json, re
+import ruamel.yaml
+
+from deployer.logger import logger
+
+
+class TemplateLoader(ruamel.yaml.SafeLoader):
+    pass
+
+# Keep shorthand intrinsic functions (!ImportValue, !Sub, ...) in their long
+# form so references can be found regardless of the notation used.
+def intrinsic_constructor(loader, tag_suffix, node):
+    if isinstance(node, ruamel.yaml.nodes.ScalarNode):
+        value = loader.construct_scalar(node)
+    elif isinstance(node, ruamel.yaml.nodes.SequenceNode):
+        value = loader.construct_sequence(node, deep=True)
+    else:
+        value = loader.construct_mapping(node, deep=True)
+    if tag_suffix == 'Ref':
+        return {'Ref': value}
+    if tag_suffix == 'GetAtt' and not isinstance(value, list):
+        value = value.split('.', 1)
+    return {'Fn::' + tag_suffix: value}
+
+TemplateLoader.add_multi_constructor(u'!', intrinsic_constructor)
+
+
+class TemplateIndex(object):
+    """Exports declared and values imported by the local templates of a config.
+
+    Export and import names are resolved statically: literal strings and
+    ``Fn::Sub`` strings whose variables are pseudo parameters or parameters
+    from the config. Anything else is ignored.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.templates = {}
+
+    def attributes(self, stack):
+        base = dict(self.config.get('global') or {})
+        block = self.config.get(stack) or {}
+        base.update(block)
+        parameters = dict((self.config.get('global') or {}).get('parameters') or {})
+        parameters.update(block.get('parameters') or {})
+        base['parameters'] = parameters
+        return base
+
+    def load(self, path):
+        if path not in self.templates:
+            try:
+                with open(path, 'r') as f:
+                    if re.match(r".*\.json$", path):
+                        self.templates[path] = json.load(f)
+                    else:
+                        self.templates[path] = ruamel.yaml.load(f, Loader=TemplateLoader)
+            except Exception as e:
+                logger.debug("Not scanning template '{}' for exports: {}".format(path, e))
+                self.templates[path] = None
+        return self.templates[path]
+
+    def regions(self, stack):
+        # Every region the stack is deployed to
+        attributes = self.attributes(stack)
+        return attributes.get('deploy_regions') or [attributes.get('region')]
+
+    def variables(self, stack, region=None):
+        attributes = self.attributes(stack)
+        variables = {
+            'AWS::StackName': attributes.get('stack_name'),
+            'AWS::Region': region or attributes.get('region'),
+            'AWS::AccountId': attributes.get('account')
+        }
+        for key, value in attributes['parameters'].items():
+            variables[key] = ','.join(value) if isinstance(value, list) else value
+        return variables
+
+    def resolve(self, value, variables):
+        if isinstance(value, dict) and list(value.keys()) == ['Fn::Sub']:
+            value = value['Fn::Sub']
+            if isinstance(value, list):
+                local = dict(variables)
+                local.update(value[1] if len(value) > 1 else {})
+                variables, value = local, value[0]
+            if not isinstance(value, str):
+                return None
+            names = re.findall(r"\$\{([^!}][^}]*)\}", value)
+            if any(not isinstance(variables.get(name), str) for name in names):
+                return None
+            return re.sub(r"\$\{([^!}][^}]*)\}", lambda m: variables[m.group(1)], value)
+        return value if isinstance(value, str) else None
+
+    def exports(self, stack, region=None):
+        template = self.template(stack)
+        variables = self.variables(stack, region)
+        names = set()
+        for output in (template.get('Outputs') or {}).values():
+            if isinstance(output, dict) and isinstance(output.get('Export'), dict):
+                name = self.resolve(output['Export'].get('Name'), variables)
+                if name:
+                    names.add(name)
+        return names
+
+    def imports(self, stack, region=None):
+        variables = self.variables(stack, region)
+        names = set()
+        pending = [self.template(stack)]
+        while pending:
+            item = pending.pop()
+            if isinstance(item, dict):
+                if 'Fn::ImportValue' in item:
+                    name = self.resolve(item['Fn::ImportValue'], variables)
+                    if name:
+                        names.add(name)
+                pending.extend(item.values())
+            elif isinstance(item, list):
+                pending.extend(item)
+        return names
+
+    def lookups(self, stack):
+        # Export names read by lookup_parameters, global and the stack's own
+        names = set()
+        for block in [self.config.get('global') or {}, self.config.get(stack) or {}]:
+            for lookup in (block.get('lookup_parameters') or {}).values():
+                if isinstance(lookup, dict) and isinstance(lookup.get('Export'), str):
+                    names.add(lookup['Export'])
+        return names
+
+    def template(self, stack):
+        path = self.attributes(stack).get('template')
+        template = self.load(path) if path else None
+        return template if isinstance(template, dict) else {}
+
+    def names(self, stack):
+        # Export and import names of a stack, as [region, name] pairs
+        found = {'exports': [], 'imports': []}
+        imports = self.attributes(stack).get('import_dependencies') is not False
+        for region in self.regions(stack):
+            found['exports'] += [[region, x] for x in sorted(self.exports(stack, region))]
+            if imports:
+                found['imports'] += [[region, x] for x in sorted(self.imports(stack, region))]
+            found['imports'] += [[region, x] for x in sorted(self.lookups(stack))]
+        return found
+
+    def dependencies(self):
+        stacks = [name for name in self.config if name != 'global']
+        return self.match(dict((stack, self.names(stack)) for stack in stacks))
+
+    @staticmethod
+    def match(names):
+        # Map every stack to the stacks exporting the values it imports
+        exporters = {}
+        for stack, found in names.items():
+            for region, name in found['exports']:
+                exporters[(region, name)] = stack
+
+        edges = {}
+        for stack, found in names.items():
+            edges[stack] = []
+            for region, name in found['imports']:
+                exporter = exporters.get((region, name))
+                if exporter and exporter != stack and exporter not in edges[stack]:
+                    logger.debug("Stack '{}' imports '{}' from stack '{}'".format(stack, name, exporter))
+                    edges[stack].append(exporter)
+        return edges
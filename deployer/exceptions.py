@@ -0,0 +1,58 @@
+class DeployerError(Exception):
+    """Base class for errors raised by deployer.
+
+    ``exit_code`` is the status the command line exits with for the error.
+    """
+    exit_code = 1
+
+
+class ConfigError(DeployerError):
+    exit_code = 3
+
+
+class SyncError(DeployerError):
+    exit_code = 4
+
+
+class LambdaPackageError(DeployerError):
+    exit_code = 5
+
+
+class AccountValidationError(DeployerError):
+    pass
+
+
+class TemplateValidationError(DeployerError):
+    pass
+
+
+class StackTimeoutError(DeployerError):
+    exit_code = 2
+
+
+class StackDeleteError(DeployerError):
+    """Raised when CloudFormation fails to delete a stack."""
+
+    def __init__(self, stack, status, reason=None):
+        self.stack = stack
+        self.status = status
+        self.reason = reason
+        message = "Delete of stack {} failed with status {}".format(stack, status)
+        super(StackDeleteError, self).__init__(message + (": " + reason if reason else "."))
+
+
+class CircularDependencyError(DeployerError):
+    def __init__(self, path):
+        self.path = path
+        super(CircularDependencyError, self).__init__("Circular dependency detected between stacks: {}".format(' -> '.join(path)))
+
+
+class DeploymentError(DeployerError):
+    """Raised when one or more stacks of a multi-stack run failed."""
+
+    def __init__(self, failed, errors):
+        self.failed = failed
+        self.errors = errors
+        codes = [getattr(errors.get(x), 'exit_code', 1) for x in failed]
+        self.exit_code = codes[0] if len(set(codes)) == 1 else 1
+        super(DeploymentError, self).__init__("Deployment failed for stack(s): {}".format(', '.join(failed)))
@@ -0,0 +1,168 @@
+import threading, time
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from deployer import interrupts
+from deployer.exceptions import DeploymentError
+from deployer.logger import logger
+
+
+SUCCEEDED = 'SUCCEEDED'
+FAILED = 'FAILED'
+SKIPPED = 'SKIPPED'
+
+
+class DeploymentExecutor(object):
+    """Runs a dependency graph of stacks with a bounded pool of workers.
+
+    ``graph`` maps every stack to the list of stacks it depends on. A stack is
+    started as soon as all of its parents have succeeded. When a stack fails,
+    no new stacks are started unless ``keep_going`` is set, in which case only
+    the stacks that depend on the failed one are skipped.
+
+    Stacks in ``external`` run somewhere else, for example on another shard.
+    They are polled every ``interval`` seconds with their check function
+    instead of taking a worker.
+
+    With more than one job, Ctrl-C cancels the updates and deletes the stacks
+    being created by workers, then raises KeyboardInterrupt without waiting
+    for them to settle.
+    """
+
+    def __init__(self, graph, jobs=1, keep_going=False):
+        self.graph = graph
+        self.jobs = max(1, jobs or 1)
+        self.keep_going = keep_going
+        self.results = {}
+        self.errors = {}
+
+    def run(self, stacks, worker, external=None, interval=15):
+        # Only schedule the requested stacks, in the order they were given
+        external = external or {}
+        self.results = {}
+        self.errors = {}
+        order = list(stacks)
+        selected = set(order)
+        parents = dict((stack, set(x for x in self.graph.get(stack, []) if x in selected)) for stack in order)
+        children = dict((stack, []) for stack in order)
+        for stack in order:
+            for parent in parents[stack]:
+                children[parent].append(stack)
+
+        if self.jobs == 1:
+            self._run_serial(order, parents, worker, external, interval)
+        else:
+            self._run_parallel(order, parents, children, worker, external, interval)
+
+        failed = [stack for stack in order if self.results.get(stack) == FAILED]
+        if failed:
+            raise DeploymentError(failed, self.errors)
+        return self.results
+
+    def _run_serial(self, order, parents, worker, external, interval):
+        # Run in the calling thread so signal handlers keep working
+        for stack in order:
+            if self._blocked(stack, parents) or (self._failed() and not self.keep_going):
+                self._skip(stack)
+                continue
+            if stack in external:
+                while not self._check(stack, external[stack]):
+                    time.sleep(interval)
+                continue
+            self._execute(stack, worker)
+
+    def _run_parallel(self, order, parents, children, worker, external, interval):
+        waiting = dict((stack, len(parents[stack])) for stack in order)
+        ready = [stack for stack in order if waiting[stack] == 0]
+        running = {}
+        watching = []
+
+        pool = ThreadPoolExecutor(max_workers=self.jobs)
+        interrupted = False
+        try:
+            while ready or running or watching:
+                stopped = not self.keep_going and self._failed()
+                if stopped:
+                    watching = []
+                else:
+                    # External stacks never hold a worker while they are waited on
+                    watching += [x for x in ready if x in external]
+                    ready = [x for x in ready if x not in external]
+                # Only submit what the pool can start right away, so nothing
+                # is left queued behind a failure or an interrupt
+                while ready and len(running) < self.jobs and not stopped:
+                    stack = ready.pop(0)
+                    running[pool.submit(self._execute, stack, worker)] = stack
+
+                finished = [x for x in watching if self._check(x, external[x])]
+                watching = [x for x in watching if x not in finished]
+                if finished:
+                    done = [x for x in running if x.done()]
+                elif running:
+                    done, _ = wait(list(running), timeout=interval if watching else None, return_when=FIRST_COMPLETED)
+                elif watching:
+                    done = []
+                    time.sleep(interval)
+                else:
+                    break
+                for stack in finished + [running.pop(future) for future in done]:
+                    for child in children[stack]:
+                        if self.results[stack] != SUCCEEDED:
+                            continue
+                        waiting[child] -= 1
+                        if waiting[child] == 0:
+                            ready.append(child)
+        except KeyboardInterrupt:
+            logger.critical('Process Interupt')
+            interrupted = True
+            interrupts.cancel_all()
+            raise
+        finally:
+            for future in running:
+                future.cancel()
+            pool.shutdown(wait=not interrupted)
+
+        # Anything that never started was blocked by a failure
+        for stack in order:
+            if stack not in self.results:
+                self._skip(stack)
+
+    def _execute(self, stack, worker):
+        thread = threading.current_thread()
+        name = thread.name
+        if self.jobs > 1:
+            thread.name = stack
+        try:
+            worker(stack)
+            self.results[stack] = SUCCEEDED
+        except BaseException as e:
+            logger.error("Stack {} failed: {}".format(stack, e))
+            self.results[stack] = FAILED
+            self.errors[stack] = e
+            if self.jobs == 1 and not isinstance(e, Exception):
+                raise
+        finally:
+            interrupts.clear()
+            thread.name = name
+
+    def _check(self, stack, check):
+        # State of a stack run elsewhere, None while it is still running
+        try:
+            if check(stack) is None:
+                return None
+            self.results[stack] = SUCCEEDED
+        except Exception as e:
+            logger.error("Stack {} failed: {}".format(stack, e))
+            self.results[stack] = FAILED
+            self.errors[stack] = e
+        return self.results[stack]
+
+    def _skip(self, stack):
+        logger.warning("Skipping stack {} due to an earlier failure".format(stack))
+        self.results[stack] = SKIPPED
+
+    def _blocked(self, stack, parents):
+        return any(self.results.get(parent) != SUCCEEDED for parent in parents[stack])
+
+    def _failed(self):
+        return FAILED in self.results.values()
@@ -0,0 +1,32 @@
+import threading
+
+
+identities = {}
+identities_pending = {}
+identities_lock = threading.Lock()
+
+def caller_identity(session):
+    # STS identity of a session's credentials, looked up once per process
+    # for each profile and access key, whatever the region. Only callers of
+    # the same key wait for its STS call.
+    credentials = session.get_credentials()
+    key = (getattr(session, 'profile_name', None), credentials.access_key if credentials else None)
+    with identities_lock:
+        if key in identities:
+            return identities[key]
+        pending = identities_pending.setdefault(key, threading.Lock())
+    with pending:
+        with identities_lock:
+            if key in identities:
+                return identities[key]
+        identity = session.client('sts').get_caller_identity()
+        with identities_lock:
+            identities[key] = identity
+            identities_pending.pop(key, None)
+        return identity
+
+def clear_identities():
+    # Forget every identity, so the next lookup calls STS again
+    with identities_lock:
+        identities.clear()
+        identities_pending.clear()
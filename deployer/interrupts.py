@@ -0,0 +1,29 @@
+import threading
+
+from deployer.logger import logger
+
+
+# Signal handlers only run in the main thread, so stacks created or updated
+# from worker threads register a cancel function here instead. The main
+# thread calls them all when it is interrupted.
+cancels = {}
+cancels_lock = threading.Lock()
+
+def register(cancel):
+    with cancels_lock:
+        cancels[threading.current_thread().ident] = cancel
+
+def clear():
+    with cancels_lock:
+        cancels.pop(threading.current_thread().ident, None)
+
+def cancel_all():
+    # Only sends the cancel requests, nothing waits for the stacks to settle
+    with cancels_lock:
+        pending = list(cancels.values())
+        cancels.clear()
+    for cancel in pending:
+        try:
+            cancel()
+        except Exception as e:
+            logger.error("Unable to cancel stack: {}".format(e))
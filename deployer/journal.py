@@ -0,0 +1,75 @@
+import hashlib, json, os, threading
+
+from deployer.logger import logger
+from deployer.repository import get_repository
+from deployer.state import state_path
+
+
+class RunJournal(object):
+    """Local record of the terminal state of every stack in a run.
+
+    The journal is keyed by the config file and release, and is written after
+    every stack so an interrupted run can be resumed with ``--resume``. A stack
+    only counts as completed when its config fingerprint still matches.
+    """
+
+    def __init__(self, config_file, release, directory=None, resume=False):
+        key = hashlib.sha256("{}:{}".format(os.path.abspath(config_file), release).encode('utf-8')).hexdigest()[:16]
+        self.path = os.path.join(directory or state_path('journal'), key + '.json')
+        self.lock = threading.Lock()
+        self.entries = {}
+        if resume:
+            self.entries = self.load()
+        else:
+            self.save()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f).get('stacks', {})
+        except (IOError, OSError, ValueError):
+            logger.debug("No run journal found at {}".format(self.path))
+            return {}
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        temp = self.path + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump({'stacks': self.entries}, f, indent=2, sort_keys=True)
+        os.replace(temp, self.path)
+
+    def completed(self, stack, fingerprint):
+        entry = self.entries.get(stack, {})
+        return entry.get('state') == 'SUCCEEDED' and entry.get('fingerprint') == fingerprint
+
+    def record(self, stack, state, fingerprint):
+        with self.lock:
+            self.entries[stack] = {'state': state, 'fingerprint': fingerprint}
+            self.save()
+
+
+def config_fingerprint(config, stack, action, params):
+    # Hash of the stack's config, template and overrides, computed without AWS
+    data = {
+        'global': config.get('global'),
+        'stack': config.get(stack),
+        'action': action,
+        'params': params
+    }
+    template = (config.get(stack) or {}).get('template') or (config.get('global') or {}).get('template')
+    try:
+        with open(template, 'r') as f:
+            data['template'] = f.read()
+    except Exception:
+        data['template'] = None
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def current_release(config):
+    release = (config.get('global') or {}).get('release')
+    if release:
+        return str(release).replace('/', '.')
+    repository = get_repository((config.get('global') or {}).get('sync_base', '.'))
+    return (repository.commit if repository else None) or 'null'
@@ -1,8 +1,9 @@
 import os, errno
 import shutil
 import subprocess
-import yaml
 
+from deployer.configuration import load_config
+from deployer.exceptions import ConfigError, LambdaPackageError
 from deployer.logger import logger
 
 
@@ -16,22 +17,17 @@ class LambdaPrep:
         self.sync_base = self.get_config_att('sync_base', '.')
 
         if not isinstance(self.lambda_dirs, list):
-            logger.error("Attribute 'lambda_dirs' must be a list.")
-            exit(5)
+            raise LambdaPackageError("Attribute 'lambda_dirs' must be a list.")
         elif not self.lambda_dirs:
             logger.warning("Lambda packaging requested but no directories specified with the 'lambda_dirs' attribute")
 
     def get_config(self, config):
-        with open(config) as f:
-            data = yaml.safe_load(f)
-        return data
+        return load_config(config).data
 
     def get_config_att(self, key, default=None, required=False):
-        base = self.config.get('global', {}).get(key, None)
-        base = self.config.get(self.environment).get(key, base)
+        base = load_config(self.config_file).attributes(self.environment).get(key, None)
         if required and base is None:
-            logger.error("Required attribute '{}' not found in config '{}'.".format(key, self.config_file))
-            exit(3)
+            raise ConfigError("Required attribute '{}' not found in config '{}'.".format(key, self.config_file))
         return base if base is not None else default
 
     #  zip_lambdas() will traverse through our configured lambda_dirs array,
@@ -0,0 +1,194 @@
+import json, os, threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+from deployer.decorators import retry
+from deployer.exceptions import ConfigError
+from deployer.identity import caller_identity
+from deployer.logger import logger
+from deployer.state import state_path
+
+
+class OutputCache(object):
+    """Outputs of the stacks read by lookup_parameters, shared by one run.
+
+    Each stack is described once per account and region and its outputs are
+    indexed by OutputKey. Concurrent lookups of the same stack wait for one
+    describe_stacks instead of making their own. Deploying or deleting a
+    stack invalidates its outputs. A ``RunContext`` holds the cache of a run,
+    and service jobs each get their own, so changes made by someone else
+    are seen by the next run or job.
+
+    Outputs are also kept on disk with the time the stack was last updated.
+    A later run checks that time against one paginated list_stacks per
+    account and region, and only describes the stacks that changed.
+
+    Exports are read from an index of every export in the account and
+    region, built once with a paginated list_exports.
+    """
+    cache_file = None
+    cache_lock = threading.Lock()
+    stable = ['CREATE_COMPLETE', 'UPDATE_COMPLETE', 'UPDATE_ROLLBACK_COMPLETE', 'IMPORT_COMPLETE', 'IMPORT_ROLLBACK_COMPLETE']
+
+    def __init__(self, jobs=8):
+        self.jobs = jobs
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.pending = {}
+        self.updates = {}
+        self.exports = {}
+
+    @staticmethod
+    def key(session, stack_name):
+        return (caller_identity(session).get('Account'), session.region_name, stack_name)
+
+    @staticmethod
+    def updated(summary):
+        return (summary.get('LastUpdatedTime') or summary['CreationTime']).isoformat()
+
+    @staticmethod
+    def disk_key(key):
+        return ':'.join(str(x) for x in key)
+
+    @retry(ClientError, logger=logger)
+    def describe(self, client, key):
+        stack = client.describe_stacks(StackName=key[2])['Stacks'][0]
+        outputs = dict((x['OutputKey'], x['OutputValue']) for x in stack.get('Outputs') or [])
+        if stack['StackStatus'] in self.stable:
+            # Outputs of a stack that is still changing are not worth keeping
+            self.save_cache(self.disk_key(key), {'updated': self.updated(stack), 'outputs': outputs})
+        return outputs
+
+    @retry(ClientError, logger=logger)
+    def list_updates(self, client):
+        updates = {}
+        for page in client.get_paginator('list_stacks').paginate(StackStatusFilter=self.stable):
+            for summary in page['StackSummaries']:
+                updates[summary['StackName']] = self.updated(summary)
+        return updates
+
+    def last_updated(self, client, key):
+        # One list_stacks per account and region serves every stack in it
+        region = key[:2]
+        with self.lock:
+            pending = self.pending.setdefault(region, threading.Lock())
+        with pending:
+            if region not in self.updates:
+                self.updates[region] = self.list_updates(client)
+        return self.updates[region].get(key[2])
+
+    @retry(ClientError, logger=logger)
+    def list_exports(self, client):
+        exports = {}
+        for page in client.get_paginator('list_exports').paginate():
+            for export in page['Exports']:
+                exports[export['Name']] = export['Value']
+        return exports
+
+    def export_index(self, client, region):
+        with self.lock:
+            pending = self.pending.setdefault(('exports',) + region, threading.Lock())
+        with pending:
+            with self.lock:
+                if region in self.exports:
+                    return self.exports[region]
+            exports = self.list_exports(client)
+            with self.lock:
+                self.exports[region] = exports
+            return exports
+
+    def cached(self, client, key):
+        # Outputs on disk, as long as the stack was not updated since
+        entry = self.load_cache().get(self.disk_key(key))
+        if entry and entry['updated'] == self.last_updated(client, key):
+            logger.debug("Using cached outputs of stack " + key[2])
+            return entry['outputs']
+        return None
+
+    def fetch(self, client, key):
+        with self.lock:
+            if key in self.entries:
+                return self.entries[key]
+            pending = self.pending.setdefault(key, threading.Lock())
+        with pending:
+            with self.lock:
+                if key in self.entries:
+                    return self.entries[key]
+            outputs = self.cached(client, key)
+            if outputs is None:
+                outputs = self.describe(client, key)
+            with self.lock:
+                self.entries[key] = outputs
+                self.pending.pop(key, None)
+            return outputs
+
+    def outputs(self, session, stack_name):
+        return self.fetch(session.client('cloudformation'), self.key(session, stack_name))
+
+    def invalidate(self, session, stack_name):
+        key = self.key(session, stack_name)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.updates.get(key[:2], {}).pop(stack_name, None)
+            self.exports.pop(key[:2], None)
+        self.save_cache(self.disk_key(key), None)
+
+    def cache_path(self):
+        return self.cache_file or state_path('cache', 'stack-outputs.json')
+
+    def load_cache(self):
+        try:
+            with open(self.cache_path()) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def save_cache(self, key, entry):
+        path = self.cache_path()
+        with self.cache_lock:
+            entries = self.load_cache()
+            if entry:
+                entries[key] = entry
+            elif entries.pop(key, None) is None:
+                return
+            try:
+                directory = os.path.dirname(path)
+                if directory and not os.path.isdir(directory):
+                    os.makedirs(directory)
+                temp = "{}.{}.tmp".format(path, os.getpid())
+                with open(temp, 'w') as f:
+                    json.dump(entries, f, indent=2, sort_keys=True)
+                os.replace(temp, path)
+            except (IOError, OSError) as e:
+                logger.debug("Unable to cache stack outputs: {}".format(e))
+
+    def resolve(self, session, lookups, exports=None):
+        # lookups maps parameters to the stack name and OutputKey they read,
+        # exports to the export name they read. Every source stack and the
+        # export index are fetched once, concurrently.
+        exports = exports or {}
+        client = session.client('cloudformation')
+        region = self.key(session, None)[:2]
+        sources = [(x, region + (x,)) for x in sorted(set(x[0] for x in lookups.values()))]
+        if exports:
+            sources.append((None, None))
+        def fetch(source):
+            return self.fetch(client, source[1]) if source[1] else self.export_index(client, region)
+        if len(sources) > 1:
+            with ThreadPoolExecutor(max_workers=min(self.jobs, len(sources))) as pool:
+                fetched = dict(zip([x[0] for x in sources], pool.map(fetch, sources)))
+        else:
+            fetched = dict((x[0], fetch(x)) for x in sources)
+
+        values = {}
+        for param_key, (stack_name, output_key) in lookups.items():
+            if output_key not in fetched[stack_name]:
+                raise ConfigError("Lookup parameter '{}' needs output '{}' of stack '{}', which does not exist.".format(param_key, output_key, stack_name))
+            values[param_key] = fetched[stack_name][output_key]
+        for param_key, name in exports.items():
+            if name not in fetched[None]:
+                raise ConfigError("Lookup parameter '{}' needs export '{}', which does not exist in region '{}'.".format(param_key, name, region[1]))
+            values[param_key] = fetched[None][name]
+        return values
@@ -0,0 +1,160 @@
+from collections import deque
+
+from deployer.discovery import TemplateIndex
+from deployer.exceptions import CircularDependencyError, ConfigError
+
+
+class DeploymentPlan(object):
+    """Dependency graph of the stacks in a config, built once and reused.
+
+    Edges come from ``lookup_parameters``, ``depends_on`` and ``Fn::ImportValue``
+    references to exports declared in other stacks' templates. The graph is
+    sorted once in linear time and grouped into levels: every stack in a level
+    only depends on stacks from earlier levels, so a level can run in parallel.
+    """
+
+    def __init__(self, config, graph=None):
+        self.graph = graph if graph is not None else self.build_graph(config)
+        self.order = self.sort()
+        self.levels = self.build_levels()
+
+    @staticmethod
+    def build_graph(config):
+        graph = {}
+        for name, stack in config.items():
+            if name == 'global':
+                continue
+            graph[name] = DeploymentPlan.stack_edges(stack or {})
+
+        # Add edges for values imported from other stacks' exports
+        for name, edges in TemplateIndex(config).dependencies().items():
+            graph[name] += [edge for edge in edges if edge not in graph[name]]
+
+        DeploymentPlan.check_graph(graph)
+        return graph
+
+    @staticmethod
+    def stack_edges(stack):
+        # Stacks named by a stack block's lookup_parameters and depends_on
+        edges = []
+        for lookup in (stack.get('lookup_parameters') or {}).values():
+            # Export lookups are matched to their exporting stack by discovery
+            if lookup.get('Stack') and lookup['Stack'] not in edges:
+                edges.append(lookup['Stack'])
+        for edge in stack.get('depends_on') or []:
+            if edge not in edges:
+                edges.append(edge)
+        return edges
+
+    @staticmethod
+    def check_graph(graph):
+        for name, edges in graph.items():
+            for edge in edges:
+                if edge not in graph:
+                    raise ConfigError("Stack '{}' depends on '{}', which is not defined in the config.".format(name, edge))
+
+    def sort(self):
+        # Kahn's algorithm, seeded in config order so the result is stable
+        waiting = dict((name, len(edges)) for name, edges in self.graph.items())
+        children = dict((name, []) for name in self.graph)
+        for name, edges in self.graph.items():
+            for edge in edges:
+                children[edge].append(name)
+
+        queue = deque(name for name in self.graph if waiting[name] == 0)
+        order = []
+        while queue:
+            name = queue.popleft()
+            order.append(name)
+            for child in children[name]:
+                waiting[child] -= 1
+                if waiting[child] == 0:
+                    queue.append(child)
+
+        if len(order) != len(self.graph):
+            raise CircularDependencyError(self.find_cycle(set(self.graph) - set(order)))
+        return order
+
+    def find_cycle(self, remaining):
+        # Every stack left over by the sort has a parent that is also left
+        # over, so walking parents must eventually revisit a stack.
+        node = next(name for name in self.graph if name in remaining)
+        path = []
+        index = {}
+        while node not in index:
+            index[node] = len(path)
+            path.append(node)
+            node = next(edge for edge in self.graph[node] if edge in remaining)
+        return path[index[node]:] + [node]
+
+    def build_levels(self):
+        self.depth = {}
+        for name in self.order:
+            self.depth[name] = max([self.depth[edge] + 1 for edge in self.graph[name]] or [0])
+        levels = []
+        for name in self.order:
+            if self.depth[name] == len(levels):
+                levels.append([])
+            levels[self.depth[name]].append(name)
+        return levels
+
+    def dependencies(self, stack):
+        # Every stack the given stack transitively depends on
+        return self.walk(stack, self.graph)
+
+    def dependents(self, stack):
+        # Every stack that transitively depends on the given stack
+        return self.walk(stack, self.children())
+
+    def children(self):
+        children = dict((name, []) for name in self.graph)
+        for name in self.order:
+            for edge in self.graph[name]:
+                children[edge].append(name)
+        return children
+
+    def walk(self, stack, edges):
+        if stack not in self.graph:
+            raise ConfigError("Stack '{}' is not defined in the config.".format(stack))
+        found = set()
+        queue = deque([stack])
+        while queue:
+            for edge in edges[queue.popleft()]:
+                if edge not in found:
+                    found.add(edge)
+                    queue.append(edge)
+        return [name for name in self.order if name in found]
+
+    def subset(self, stacks):
+        # Plan restricted to the given stacks, keeping only edges between them
+        selected = set(stacks)
+        for stack in selected:
+            if stack not in self.graph:
+                raise ConfigError("Stack '{}' is not defined in the config.".format(stack))
+        graph = dict((name, [x for x in self.graph[name] if x in selected]) for name in self.order if name in selected)
+        return DeploymentPlan(None, graph)
+
+    def reverse(self):
+        # Teardown plan: every stack waits for the stacks that depend on it
+        children = self.children()
+        return DeploymentPlan(None, dict((name, children[name]) for name in reversed(self.order)))
+
+    @property
+    def critical_path(self):
+        # Longest chain of dependent stacks, which bounds a parallel run
+        if not self.order:
+            return []
+        node = max(self.order, key=lambda name: self.depth[name])
+        path = [node]
+        while self.graph[node]:
+            node = max(self.graph[node], key=lambda name: self.depth[name])
+            path.append(node)
+        path.reverse()
+        return path
+
+    def format(self):
+        lines = []
+        for count, level in enumerate(self.levels, 1):
+            lines.append("Level {}: {}".format(count, ', '.join(level)))
+        lines.append("Critical path: {}".format(' -> '.join(self.critical_path)))
+        return '\n'.join(lines)
@@ -0,0 +1,124 @@
+import os, re, threading
+
+
+class Repository(object):
+    """Commit and origin of a git checkout, read straight from its files.
+
+    HEAD, loose refs and packed-refs are read without running git. The
+    commit is only resolved again when one of those files changes, so
+    a long running process still sees new commits.
+    """
+
+    def __init__(self, git_dir):
+        self.git_dir = git_dir
+        self.common_dir = git_dir
+        commondir = self.read(os.path.join(git_dir, 'commondir'))
+        if commondir:
+            # Worktrees keep their own HEAD but share refs and config
+            self.common_dir = os.path.normpath(os.path.join(git_dir, commondir.strip()))
+        self.lock = threading.Lock()
+        self.resolved = (None, None)
+        self._origin = False
+
+    @staticmethod
+    def read(path):
+        try:
+            with open(path) as f:
+                return f.read()
+        except (IOError, OSError):
+            return None
+
+    @staticmethod
+    def stat(path):
+        try:
+            stat = os.stat(path)
+            return (stat.st_mtime, stat.st_size)
+        except OSError:
+            return None
+
+    def ref_paths(self, ref):
+        return [os.path.join(self.git_dir, ref), os.path.join(self.common_dir, ref)]
+
+    def state(self):
+        # Files the commit is resolved from, to notice when it moves
+        head = (self.read(os.path.join(self.git_dir, 'HEAD')) or '').strip()
+        paths = [os.path.join(self.git_dir, 'HEAD'), os.path.join(self.common_dir, 'packed-refs')]
+        if head.startswith('ref:'):
+            paths += self.ref_paths(head[4:].strip())
+        return head, tuple(self.stat(x) for x in paths)
+
+    @property
+    def commit(self):
+        head, stats = self.state()
+        with self.lock:
+            if self.resolved[0] != (head, stats):
+                self.resolved = ((head, stats), self.resolve(head))
+            return self.resolved[1]
+
+    def resolve(self, head, depth=0):
+        if not head.startswith('ref:'):
+            return head if re.match(r"^[0-9a-f]{40}([0-9a-f]{24})?$", head) else None
+        if depth > 5:
+            return None
+        ref = head[4:].strip()
+        for path in self.ref_paths(ref):
+            value = (self.read(path) or '').strip()
+            if value:
+                # Symbolic refs point at other refs
+                return self.resolve(value, depth + 1)
+        for line in (self.read(os.path.join(self.common_dir, 'packed-refs')) or '').splitlines():
+            if line and line[0] not in '#^':
+                sha, _, name = line.partition(' ')
+                if name.strip() == ref:
+                    return sha
+        return None
+
+    @property
+    def origin(self):
+        # URL of the origin remote without credentials, read once
+        with self.lock:
+            if self._origin is False:
+                self._origin = None
+                section = None
+                for line in (self.read(os.path.join(self.common_dir, 'config')) or '').splitlines():
+                    line = line.strip()
+                    if line.startswith('['):
+                        section = re.sub(r"\s+", ' ', line.strip('[]').strip())
+                    elif section == 'remote "origin"' and '=' in line:
+                        key, _, value = line.partition('=')
+                        if key.strip() == 'url':
+                            self._origin = value.strip().split('@', 1)[-1]
+                            break
+            return self._origin
+
+
+repositories = {}
+repository_bases = {}
+repositories_lock = threading.Lock()
+
+def find_git_dir(base):
+    path = os.path.abspath(base)
+    while True:
+        candidate = os.path.join(path, '.git')
+        if os.path.isdir(candidate):
+            return candidate
+        if os.path.isfile(candidate):
+            # Worktrees and submodules point at their git directory
+            content = Repository.read(candidate) or ''
+            if content.startswith('gitdir:'):
+                return os.path.normpath(os.path.join(path, content[len('gitdir:'):].strip()))
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+def get_repository(base='.'):
+    # Repository containing base, shared by the whole process, or None
+    key = os.path.abspath(base)
+    with repositories_lock:
+        if key not in repository_bases:
+            repository_bases[key] = find_git_dir(base)
+        git_dir = repository_bases[key]
+        if git_dir and git_dir not in repositories:
+            repositories[git_dir] = Repository(git_dir)
+        return repositories.get(git_dir)
@@ -1,14 +1,15 @@
-import fnmatch, git, hashlib, os, re, yaml
-from boto3.session import Session
+import fnmatch, hashlib, os, re
 from botocore.exceptions import ClientError
 
 from deployer.decorators import retry
+from deployer.exceptions import DeployerError, SyncError, TemplateValidationError
 from deployer.logger import logger
+from deployer.repository import get_repository
 
 import sys, traceback
 
 class s3_sync(object):
-    def __init__(self, session, config, bucket, valid=False, debug=False):
+    def __init__(self, session, config, bucket, valid=False, debug=False, auto_sync=True):
         try:
             # Pass parameters
             self.session = session
@@ -25,7 +26,7 @@ class s3_sync(object):
 
             # Repo based values
             self.repository = self.get_repository()
-            self.commit = self.repository.head.object.hexsha if self.repository else 'null'
+            self.commit = (self.repository.commit if self.repository else None) or 'null'
             self.release = self.config.get_config_att('release', self.commit).replace('/', '.')
             
             # AWS Clients
@@ -36,23 +37,22 @@ class s3_sync(object):
             self.excludes = self.construct_excludes()
 
             if not isinstance(self.sync_dirs, list):
-                logger.error("Attribute 'sync_dirs' must be a list.")
-                exit(4)
+                raise SyncError("Attribute 'sync_dirs' must be a list.")
             elif not self.sync_dirs:
                 logger.warning("Sync requested but no directories specified with the 'sync_dirs' attribute")
 
-            self.sync()
+            if auto_sync:
+                self.sync()
+        except DeployerError:
+            raise
         except (Exception) as e:
-            logger.error(e)
             if self.debug:
                 tb = sys.exc_info()[2]
                 traceback.print_tb(tb)
+            raise SyncError("Sync failed: {}".format(e)) from e
 
     def get_repository(self):
-        try:
-            return git.Repo(self.base, search_parent_directories=True)
-        except git.exc.InvalidGitRepositoryError:
-            return None
+        return get_repository(self.base)
 
     def construct_excludes(self):
         excludes = self.config.get_config_att('sync_exclude')
@@ -75,36 +75,42 @@ class s3_sync(object):
             etag = '"%s"' % md5s[0].hexdigest()
         return etag
     
+    def is_template(self, fname):
+        # Templates are validated with CloudFormation before they are sent
+        return re.match(r".*cloudformation.*\.(json|yml)$", fname) is not None
+
     @retry(ClientError,logger=logger)
     def validate(self, fname, dest_key):
-        if re.match(".*cloudformation.*\.(json|yml)$", fname):
+        if self.is_template(fname):
             try:
                 etag = self.generate_etag(fname)
             except:
-                filesize = os.stat(fname).st_size
-                validate_path = "deployer_validate/%s" % dest_key
-                if self.region != 'us-east-1':
-                    validate_url = "https://s3-%s.amazonaws.com/%s/%s" % (self.region, self.cloudtools_bucket.name, validate_path)
-                else:
-                    validate_url = "https://s3.amazonaws.com/%s/%s" % (self.cloudtools_bucket.name, validate_path)
-                try: 
-                    if filesize > 51200:
-                        self.client.upload_file(fname, self.cloudtools_bucket.name, validate_path)
-                        self.cfn.validate_template(TemplateURL=validate_url)
-                        self.client.delete_object(Bucket=self.cloudtools_bucket.name, Key=validate_path)
-                    else:
-                        with open(fname, 'r') as f:
-                            self.cfn.validate_template(TemplateBody=f.read())
-                except Exception as e:
-                    self.validate_failed(fname, validate_url, str(e))
-
-    def validate_failed(self, fname, validate_url, message):
+                self.validate_file(fname, dest_key)
+
+    def validate_file(self, fname, dest_key):
+        filesize = os.stat(fname).st_size
+        validate_path = "deployer_validate/%s" % dest_key
+        if self.region != 'us-east-1':
+            validate_url = "https://s3-%s.amazonaws.com/%s/%s" % (self.region, self.cloudtools_bucket.name, validate_path)
+        else:
+            validate_url = "https://s3.amazonaws.com/%s/%s" % (self.cloudtools_bucket.name, validate_path)
+        try: 
+            if filesize > 51200:
+                self.client.upload_file(fname, self.cloudtools_bucket.name, validate_path)
+                self.cfn.validate_template(TemplateURL=validate_url)
+                self.client.delete_object(Bucket=self.cloudtools_bucket.name, Key=validate_path)
+            else:
+                with open(fname, 'r') as f:
+                    self.cfn.validate_template(TemplateBody=f.read())
+        except Exception as e:
+            self.validate_failed(fname, validate_path, str(e))
+
+    def validate_failed(self, fname, validate_path, message):
         try:
-            logger.critical("Failed to Validate: %s\n%s" % (fname, message))
             self.client.delete_object(Bucket=self.cloudtools_bucket.name, Key=validate_path)
-            exit(1)
-        except:
-            exit(1)
+        except Exception:
+            pass
+        raise TemplateValidationError("Failed to Validate: %s\n%s" % (fname, message))
 
     def generate_dest_key(self, fname, thisdir):
         only_fname = os.path.split(fname)[1]
@@ -132,12 +138,13 @@ class s3_sync(object):
             self.client.upload_file(fname, self.cloudtools_bucket.name, dest_key)
             logger.info("Uploaded: %s to s3://%s/%s" % (fname, self.cloudtools_bucket.name, dest_key))
         except (Exception) as e:
-            logger.error(e)
             if self.debug:
                 tb = sys.exc_info()[2]
                 traceback.print_tb(tb)
-                
-    def upload(self):
+            raise SyncError("Failed to upload {} to s3://{}/{}: {}".format(fname, self.cloudtools_bucket.name, dest_key, e)) from e
+
+    def files(self):
+        # Every file under sync_dirs that is not excluded, with its S3 key
         if self.sync_dirs:
             for sync_dir in self.sync_dirs:
                 sync_dir = sync_dir.strip(".")
@@ -147,41 +154,17 @@ class s3_sync(object):
                     if self.excludes:
                         for ignore in self.excludes:
                             fileList = [n for n in fileList if not fnmatch.fnmatch(n,ignore)]
-                    procs = []
                     for fname in fileList:
-                        dest_key = self.generate_dest_key(fname, thisdir)
-                        if os.name != 'nt':
-                            self.skip_or_send(fname, dest_key)
-                        else:
-                            self.skip_or_send(fname, dest_key)
-                    list(map(lambda x: x.join(), procs))
+                        yield fname, self.generate_dest_key(fname, thisdir)
+
+    def upload(self):
+        for fname, dest_key in self.files():
+            self.skip_or_send(fname, dest_key)
+
     def test(self):
         logger.info("Validating Templates")
-        if self.sync_dirs:
-            count = 0
-            processes = []
-            for sync_dir in self.sync_dirs:
-                sync_dir = sync_dir.strip(".")
-                for dirName, subdirList, fileList in os.walk("%s%s" %(self.base,sync_dir)):
-                    thisdir = "".join(dirName.rsplit(self.base)).strip("/")
-                    fileList = [os.path.join(dirName,filename) for filename in fileList]
-                    if self.excludes:
-                        for ignore in self.excludes:
-                            fileList = [n for n in fileList if not fnmatch.fnmatch(n,ignore)] 
-                    for fname in fileList:
-                        dest_key = self.generate_dest_key(fname, thisdir)
-                        if os.name != 'nt':
-                            self.validate(fname, dest_key)
-                        else:
-                            self.validate(fname,dest_key)
-                        count += 1
-            if len(processes) != 0:
-                for process in processes: 
-                    process.join()
-                for process in processes: 
-                    if process.exitcode:
-                        logger.critical("Failed to validate templates before upload")
-                        exit(1)
+        for fname, dest_key in self.files():
+            self.validate(fname, dest_key)
 
     def sync(self):
         if self.valid:
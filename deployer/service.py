@@ -0,0 +1,238 @@
+import hmac, ipaddress, json, os, stat, threading, uuid
+
+from collections import OrderedDict, deque
+
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn, UnixStreamServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn, UnixStreamServer
+
+from deployer.api import Deployer, ACTIONS
+from deployer.exceptions import ConfigError
+from deployer.logger import logger
+from deployer.outputs import OutputCache
+
+
+class DeployerService(object):
+    """Runs deploy, sync and describe jobs against warm sessions and configs.
+
+    Jobs are queued and run by a bounded pool of workers. Every job shares the
+    same ``RunContext``, so sessions and caches survive between jobs and their
+    API calls count against one budget. Stack outputs are the exception: each
+    job resolves lookup_parameters with its own ``OutputCache``, revalidated
+    against the on disk cache, so stacks changed by someone else are seen.
+
+    Deploy and sync jobs on the same stack of the same config run one at a
+    time, in the order they were queued. A stack's next job only goes to the
+    pool once its previous one finished, so a backlog on one stack does not
+    hold workers other stacks could use. When ``token`` is set, requests must
+    send it as ``Authorization: Bearer <token>``.
+    """
+
+    def __init__(self, context, jobs=1, options=None, token=None):
+        self.context = context
+        self.options = options or {}
+        self.token = token
+        self.pool = ThreadPoolExecutor(max_workers=jobs)
+        self.lock = threading.Lock()
+        self.jobs = OrderedDict()
+        self.stack_queues = {}
+        self.history = 1000
+
+    def deployer(self, config_file):
+        # Parsed configs are cached by load_config until they change on disk
+        return Deployer(config_file, context=self.context, outputs=OutputCache(), **self.options)
+
+    def submit(self, request):
+        if not isinstance(request, dict):
+            raise ValueError("A job must be a JSON object.")
+        action = request.get('action')
+        if action not in ['deploy', 'sync', 'describe', 'plan']:
+            raise ValueError("Unknown action '{}'.".format(action))
+        if action == 'deploy' and request.get('execute', 'upsert') not in ACTIONS:
+            raise ValueError("Unknown execute '{}'.".format(request.get('execute')))
+        if not request.get('config'):
+            raise ValueError("A config is required.")
+        if action != 'plan' and not request.get('stack'):
+            raise ValueError("A stack is required.")
+
+        job = {'id': str(uuid.uuid4()), 'state': 'QUEUED', 'request': request}
+        with self.lock:
+            self.jobs[job['id']] = job
+            # Forget the oldest finished jobs
+            finished = [x for x, y in self.jobs.items() if y['state'] in ['SUCCEEDED', 'FAILED']]
+            for job_id in finished[:max(0, len(self.jobs) - self.history)]:
+                del self.jobs[job_id]
+        self.schedule(job)
+        return self.job(job['id']) or job
+
+    def authorized(self, header):
+        if not self.token:
+            return True
+        return hmac.compare_digest((header or '').encode('utf-8'), ('Bearer ' + self.token).encode('utf-8'))
+
+    def stack_key(self, request):
+        # CloudFormation rejects a second operation on a stack that is busy
+        if request['action'] not in ['deploy', 'sync']:
+            return None
+        return (os.path.abspath(request['config']), request['stack'])
+
+    def schedule(self, job):
+        key = self.stack_key(job['request'])
+        if key:
+            with self.lock:
+                if key in self.stack_queues:
+                    self.stack_queues[key].append(job)
+                    return
+                self.stack_queues[key] = deque()
+        self.pool.submit(self.run, job)
+
+    def run(self, job):
+        try:
+            self.execute(job)
+        finally:
+            key = self.stack_key(job['request'])
+            if key:
+                with self.lock:
+                    queue = self.stack_queues[key]
+                    following = queue.popleft() if queue else None
+                    if not following:
+                        del self.stack_queues[key]
+                if following:
+                    self.pool.submit(self.run, following)
+
+    def execute(self, job):
+        request = job['request']
+        self.update(job, state='RUNNING')
+        logger.info("Running job {}: {}".format(job['id'], request))
+        try:
+            deployer = self.deployer(request['config'])
+            result = None
+            if request['action'] == 'deploy':
+                deployer.deploy(request['stack'], request.get('execute', 'upsert'))
+            elif request['action'] == 'sync':
+                deployer.sync(request['stack'])
+            elif request['action'] == 'describe':
+                result = deployer.describe(request['stack'])
+            else:
+                plan = deployer.plan(request.get('stack'), request.get('with_dependencies', False), request.get('with_dependents', False))
+                result = {'levels': plan.levels, 'critical_path': plan.critical_path}
+            self.update(job, state='SUCCEEDED', result=result)
+        except Exception as e:
+            logger.error("Job {} failed: {}".format(job['id'], e))
+            self.update(job, state='FAILED', error=str(e))
+
+    def update(self, job, **values):
+        with self.lock:
+            job.update(values)
+
+    def job(self, job_id):
+        # Copies, so responses are not serialized while a worker updates them
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    def list_jobs(self):
+        with self.lock:
+            return [dict(x) for x in self.jobs.values()]
+
+
+class ServiceRequestHandler(BaseHTTPRequestHandler):
+    service = None
+
+    def authorize(self):
+        if self.service.authorized(self.headers.get('Authorization')):
+            return True
+        self.respond(401, {'error': 'Unauthorized'})
+        return False
+
+    def do_GET(self):
+        if not self.authorize():
+            return
+        parts = [x for x in self.path.split('?', 1)[0].split('/') if x]
+        if parts == ['jobs']:
+            self.respond(200, self.service.list_jobs())
+        elif len(parts) == 2 and parts[0] == 'jobs' and self.service.job(parts[1]):
+            self.respond(200, self.service.job(parts[1]))
+        else:
+            self.respond(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        if not self.authorize():
+            return
+        if self.path.split('?', 1)[0].rstrip('/') != '/jobs':
+            self.respond(404, {'error': 'Not found'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length).decode('utf-8') or '{}')
+            self.respond(202, self.service.submit(request))
+        except ValueError as e:
+            self.respond(400, {'error': str(e)})
+
+    def respond(self, status, body):
+        data = json.dumps(body, sort_keys=True, default=lambda x: x.isoformat()).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'local'
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s" % (self.address_string(), format % args))
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = self.socket.accept()
+        return request, ('local', 0)
+
+
+def is_loopback(host):
+    try:
+        return ipaddress.ip_address(host.strip('[]')).is_loopback
+    except ValueError:
+        return host == 'localhost'
+
+
+def make_server(service, listen='127.0.0.1:8080', socket_path=None):
+    # Jobs can deploy and delete any stack, so anything reachable from other
+    # machines must be protected by a token
+    handler = type('Handler', (ServiceRequestHandler,), {'service': service})
+    if socket_path:
+        if os.path.exists(socket_path):
+            if not stat.S_ISSOCK(os.stat(socket_path).st_mode):
+                raise ConfigError("Refusing to replace '{}', which is not a socket.".format(socket_path))
+            os.remove(socket_path)
+        logger.info("Deployer service listening on " + socket_path)
+        return ThreadingUnixHTTPServer(socket_path, handler)
+    host, _, port = listen.rpartition(':')
+    host = host or '127.0.0.1'
+    if not is_loopback(host) and not service.token:
+        raise ConfigError("Refusing to listen on '{}' without a token, set DEPLOYER_SERVICE_TOKEN.".format(listen))
+    server = ThreadingHTTPServer((host, int(port)), handler)
+    logger.info("Deployer service listening on {}:{}".format(host, server.server_address[1]))
+    return server
+
+
+def serve(service, listen='127.0.0.1:8080', socket_path=None):
+    server = make_server(service, listen, socket_path)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        service.pool.shutdown(wait=False)
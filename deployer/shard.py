@@ -0,0 +1,143 @@
+import json, os, time
+
+from deployer.logger import logger
+
+
+def parse_shard(value):
+    # Parse `K/N` into a zero based shard index and a shard count
+    try:
+        index, count = [int(x) for x in value.split('/', 1)]
+    except ValueError:
+        raise ValueError("Shard must be in the form K/N, for example 2/4.")
+    if count < 1 or index < 1 or index > count:
+        raise ValueError("Shard '{}' is out of range.".format(value))
+    return index - 1, count
+
+
+def assign_shards(plan, count):
+    """Assign every stack in a plan to one of `count` shards.
+
+    Independent subgraphs (weakly connected components) are kept whole and
+    handed out largest first to the least loaded shard. A subgraph that is
+    larger than an even share is split by level instead, so stacks of the same
+    level run on different shards and only its edges cross shards.
+    """
+    neighbours = dict((name, set(edges)) for name, edges in plan.graph.items())
+    for name, edges in plan.graph.items():
+        for edge in edges:
+            neighbours[edge].add(name)
+
+    position = dict((name, index) for index, name in enumerate(plan.order))
+    components = []
+    seen = set()
+    for name in plan.order:
+        if name in seen:
+            continue
+        component = []
+        pending = [name]
+        seen.add(name)
+        while pending:
+            node = pending.pop()
+            component.append(node)
+            for neighbour in neighbours[node]:
+                if neighbour not in seen:
+                    seen.add(neighbour)
+                    pending.append(neighbour)
+        components.append(sorted(component, key=position.get))
+    components.sort(key=lambda x: -len(x))
+
+    share = -(-len(plan.order) // count)
+    load = [0] * count
+    assignments = {}
+    for component in components:
+        if len(component) <= share:
+            shard = load.index(min(load))
+            for name in component:
+                assignments[name] = shard
+            load[shard] += len(component)
+            continue
+        members = set(component)
+        for level in plan.levels:
+            for name in level:
+                if name in members:
+                    shard = load.index(min(load))
+                    assignments[name] = shard
+                    load[shard] += 1
+    return assignments
+
+
+class FileMarkerStore(object):
+    def __init__(self, directory):
+        self.directory = directory
+
+    def put(self, run_id, stack, state):
+        directory = os.path.join(self.directory, run_id)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        temp = os.path.join(directory, stack + '.tmp')
+        with open(temp, 'w') as f:
+            json.dump({'state': state}, f)
+        os.replace(temp, os.path.join(directory, stack))
+
+    def get(self, run_id, stack):
+        try:
+            with open(os.path.join(self.directory, run_id, stack)) as f:
+                return json.load(f).get('state')
+        except (IOError, OSError, ValueError):
+            return None
+
+
+class S3MarkerStore(object):
+    def __init__(self, client, bucket, prefix='deployer/markers'):
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+
+    def key(self, run_id, stack):
+        return '/'.join([x for x in [self.prefix, run_id, stack] if x])
+
+    def put(self, run_id, stack, state):
+        self.client.put_object(Bucket=self.bucket, Key=self.key(run_id, stack), Body=json.dumps({'state': state}).encode('utf-8'))
+
+    def get(self, run_id, stack):
+        from botocore.exceptions import ClientError
+        try:
+            result = self.client.get_object(Bucket=self.bucket, Key=self.key(run_id, stack))
+            return json.loads(result['Body'].read().decode('utf-8')).get('state')
+        except ClientError as e:
+            if e.response['Error']['Code'] in ['NoSuchKey', '404']:
+                return None
+            raise e
+
+
+class ShardCoordinator(object):
+    """Publishes and checks stack completion markers shared by all shards.
+
+    A stack that has no marker ``timeout`` seconds after it was first checked
+    is reported as failed, so a lost shard cannot hang the others forever.
+    """
+
+    def __init__(self, store, run_id, interval=15, timeout=10800):
+        self.store = store
+        self.run_id = run_id
+        self.interval = interval
+        self.timeout = timeout
+        self.started = {}
+
+    def publish(self, stack, state):
+        logger.debug("Publishing {} marker for stack {}".format(state, stack))
+        self.store.put(self.run_id, stack, state)
+
+    def check(self, stack):
+        # SUCCEEDED once the other shard is done, None while it is not
+        state = self.store.get(self.run_id, stack)
+        if state == 'SUCCEEDED':
+            return state
+        if state is not None:
+            raise RuntimeError("Stack {} finished with {} on another shard".format(stack, state))
+        if stack not in self.started:
+            logger.info("Waiting for stack " + stack + " on another shard")
+            self.started[stack] = time.time()
+        if self.timeout is not None and time.time() - self.started[stack] > self.timeout:
+            raise RuntimeError("Timed out waiting for stack {} on another shard".format(stack))
+        return None
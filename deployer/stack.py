@@ -1,9 +1,13 @@
+from deployer import interrupts
 from deployer.cloudformation import AbstractCloudFormation
-from deployer.decorators import retry
+from deployer.decorators import lazy_property, retry
+from deployer.exceptions import StackDeleteError, StackTimeoutError
+from deployer.identity import caller_identity
 from deployer.logger import logger
+from deployer.outputs import OutputCache
 from deployer.cloudtools_bucket import CloudtoolsBucket
 
-import signal, pytz
+import hashlib, json, os, signal, pytz, threading
 
 from collections import defaultdict
 from botocore.exceptions import ClientError, WaiterError
@@ -36,18 +40,12 @@ class Stack(AbstractCloudFormation):
         ))
         self.colors = args.get('colors', defaultdict(lambda: ''))
         self.params = args.get('params', {})
+        self.force = args.get('force', False)
+        self.output_cache = args.get('outputs') or OutputCache()
 
         # Load values from config
         self.stack_name = self.config.get_config_att('stack_name', required=True, stack=self.stack)
         self.base = self.config.get_config_att('sync_base', '.')
-
-        # Load values from methods for config lookup
-        self.repository = self.get_repository(self.base)
-        self.commit = self.repository.head.object.hexsha if self.repository else 'null'
-
-        # Load values from config
-        self.release = self.config.get_config_att('release', self.commit).replace('/','.')
-        self.template = self.config.get_config_att('template', required=True)
         self.timeout = self.timed_out if self.timed_out is not None else self.config.get_config_att('timeout', None)
         self.transforms = self.config.get_config_att('transforms')
 
@@ -55,20 +53,53 @@ class Stack(AbstractCloudFormation):
         self.client = self.session.client('cloudformation')
         self.sts = self.session.client('sts')
 
-        # Load values from methods
-        self.origin = self.get_repository_origin(self.repository) if self.repository else 'null'
-        self.identity_arn = self.sts.get_caller_identity().get('Arn', '')
-        if bucket:
-            self.template_url = self.bucket.construct_template_url(self.config, self.stack, self.release, self.template) # self.construct_template_url()
-            self.template_file = self.bucket.get_template_file(self.config, self.stack)
-            self.template_body = self.bucket.get_template_body(self.config, self.template)
-
         # Set state values
         self._timed_out = False
 
-        self.validate_account(self.session, self.config)
-        self.reload_stack_status()
+    # The attributes below read files or call AWS, so they are only computed
+    # once an action needs them. A describe or lookup only pays for
+    # describe_stacks.
+
+    @lazy_property
+    def repository(self):
+        return self.get_repository(self.base)
+
+    @lazy_property
+    def commit(self):
+        return (self.repository.commit if self.repository else None) or 'null'
+
+    @lazy_property
+    def origin(self):
+        return self.get_repository_origin(self.repository) if self.repository else 'null'
 
+    @lazy_property
+    def release(self):
+        release = self.config.get_config_att('release')
+        return (release if release is not None else self.commit).replace('/','.')
+
+    @lazy_property
+    def template(self):
+        return self.config.get_config_att('template', required=True)
+
+    @lazy_property
+    def identity_arn(self):
+        return caller_identity(self.session).get('Arn', '')
+
+    @lazy_property
+    def template_url(self):
+        return self.bucket.construct_template_url(self.config, self.stack, self.release, self.template)
+
+    @lazy_property
+    def template_file(self):
+        return self.bucket.get_template_file(self.config, self.stack)
+
+    @lazy_property
+    def template_body(self):
+        return self.bucket.get_template_body(self.config, self.template)
+
+    @lazy_property
+    def stack_status(self):
+        return self.reload_stack_status()
 
     def reload_change_set_status(self, change_set_name): 
         try:
@@ -81,21 +112,96 @@ class Stack(AbstractCloudFormation):
             self.change_set_status = 'False'
         return self.change_set_status
 
-    def construct_tags(self): 
+    def construct_tags(self, fingerprint=None): 
         tags = self.config.get_config_att('tags')
+        meta_tags = self.config.get_config_att('meta_tags') != False
         if tags:
             tags = [ { 'Key': key, 'Value': value } for key, value in tags.items() ] 
-            if len(tags) > 47:
-                raise ValueError('Resources tag limit is 50, you have provided more than 47 tags. Please limit your tagging, save room for name and deployer tags.')
+            # Meta tags take up room for one more tag, the fingerprint
+            limit = 44 if meta_tags else 47
+            if len(tags) > limit:
+                raise ValueError('Resources tag limit is 50, you have provided more than {} tags. Please limit your tagging, save room for name and deployer tags.'.format(limit))
         else:
             tags = []
-        if self.config.get_config_att('meta_tags') != False:
+        if meta_tags:
             tags.append({'Key': 'deployer:stack', 'Value': self.stack})
             tags.append({'Key': 'deployer:caller', 'Value': self.identity_arn})
             tags.append({'Key': 'deployer:git:commit', 'Value': self.commit})
             tags.append({'Key': 'deployer:git:origin', 'Value': self.origin})
             tags.append({'Key': 'deployer:config', 'Value': self.config.file_name.replace('\\', '/')})
+            if fingerprint:
+                tags.append({'Key': 'deployer:fingerprint', 'Value': fingerprint})
         return tags
+
+    def fingerprint(self, args):
+        # Hash of everything sent to CloudFormation, including the resolved
+        # parameters, so a changed upstream output changes the fingerprint.
+        # Meta tags change with every commit and caller and are left out, as
+        # are the TemplateURL and the Release parameter when the release is
+        # the commit. The template contents are hashed instead.
+        content = self.template_body
+        if content is None:
+            content = self.read_file(self.template_file)
+        data = dict((key, args.get(key)) for key in ['TemplateBody', 'Parameters', 'Capabilities'])
+        if self.config.get_config_att('release') is None:
+            data['Parameters'] = [x for x in args.get('Parameters') or [] if x['ParameterKey'] != 'Release']
+        data['Tags'] = [x for x in args.get('Tags') or [] if not x['Key'].startswith('deployer:')]
+        data['TemplateContent'] = content
+        data['NestedTemplates'] = dict((x, self.read_file(x)) for x in self.nested_templates(self.template_file))
+        return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def read_file(path):
+        try:
+            with open(path, 'r') as f:
+                return f.read()
+        except Exception:
+            return None
+
+    def nested_templates(self, path, found=None):
+        # Local copies of the templates of nested stacks, found by matching
+        # the end of their TemplateURL against files under sync_base
+        from deployer.discovery import TemplateIndex
+        found = found if found is not None else []
+        template = TemplateIndex({}).load(path) if path and os.path.isfile(path) else None
+        resources = template.get('Resources') if isinstance(template, dict) else None
+        for resource in (resources or {}).values():
+            if not isinstance(resource, dict) or resource.get('Type') != 'AWS::CloudFormation::Stack':
+                continue
+            pending = [(resource.get('Properties') or {}).get('TemplateURL')]
+            while pending:
+                item = pending.pop()
+                if isinstance(item, dict):
+                    pending.extend(item.values())
+                elif isinstance(item, list):
+                    pending.extend(item)
+                elif isinstance(item, str):
+                    child = self.local_template(item, os.path.dirname(path))
+                    if child and child not in found:
+                        found.append(child)
+                        self.nested_templates(child, found)
+        return found
+
+    def local_template(self, url, directory):
+        parts = url.split('/')
+        for index in range(len(parts)):
+            tail = parts[index:]
+            if any(not x or '${' in x or ':' in x for x in tail):
+                continue
+            for base in [self.base, directory]:
+                candidate = os.path.normpath(os.path.join(base, *tail))
+                if os.path.isfile(candidate):
+                    return candidate
+        return None
+
+    def deployed_fingerprint(self):
+        stack = self.describe()
+        if stack.get('StackStatus') not in ['CREATE_COMPLETE', 'UPDATE_COMPLETE']:
+            return None
+        for tag in stack.get('Tags', []):
+            if tag['Key'] == 'deployer:fingerprint':
+                return tag['Value']
+        return None
         
 
     def create_waiter(self, start_time):
@@ -108,8 +214,7 @@ class Stack(AbstractCloudFormation):
                 self.output_events(start_time, 'create')
             except RuntimeError as e:
                 if self.timed_out:
-                    logger.error('Stack creation exceeded timeout of {} minutes and was aborted.'.format(self.timeout))
-                    exit(2)
+                    raise StackTimeoutError('Stack creation exceeded timeout of {} minutes and was aborted.'.format(self.timeout))
                 else:
                     raise e
         else:
@@ -131,8 +236,7 @@ class Stack(AbstractCloudFormation):
                 self.output_events(start_time, 'update')
             except RuntimeError as e:
                 if self.timed_out:
-                    logger.error('Stack creation exceeded timeout of {} minutes and was aborted.'.format(self.timeout))
-                    exit(2)
+                    raise StackTimeoutError('Stack creation exceeded timeout of {} minutes and was aborted.'.format(self.timeout))
                 else:
                     raise e
         else:
@@ -192,10 +296,27 @@ class Stack(AbstractCloudFormation):
             count += 1
 
     def delete_stack(self):
+        self.validate_account(self.session, self.config)
+        if self.stack_status == 'False':
+            logger.info("Stack " + self.stack_name + " does not exist, nothing to delete")
+            return True
         self.client.delete_stack(StackName=self.stack_name)
         logger.info(self.colors['error'] + "Sent delete request to stack" + self.colors['reset'])
+        self.delete_waiter()
+        self.forget_outputs()
         return True
 
+    def delete_waiter(self):
+        # Parents can only be deleted once their dependents are gone
+        waiter = self.client.get_waiter('stack_delete_complete')
+        try:
+            waiter.wait(StackName=self.stack_name)
+        except WaiterError as e:
+            status = self.reload_stack_status()
+            logger.info(status)
+            raise StackDeleteError(self.stack_name, status, self.stack_status_reason) from e
+        logger.info("Delete complete!")
+
     def get_latest_change_set_name(self):
         resp = {}
         latest = None
@@ -219,12 +340,13 @@ class Stack(AbstractCloudFormation):
         return latest['ChangeSetName']
 
     def get_change_set(self, change_set_name, change_set_description, change_set_type):
+        self.validate_account(self.session, self.config)
         # create the change set
         if self.stack_status: 
             resp = self.client.create_change_set(
                 StackName=self.stack_name,
                 TemplateURL=self.template_url,
-                Parameters=self.config.build_params(self.session, self.stack, self.release, self.params, self.template_file),
+                Parameters=self.config.build_params(self.session, self.stack, self.release, self.params, self.template_file, self.output_cache),
                 Capabilities=[
                     'CAPABILITY_IAM',
                     'CAPABILITY_NAMED_IAM',
@@ -291,13 +413,14 @@ class Stack(AbstractCloudFormation):
         self.update_stack() if self.exists() else self.create_stack()
 
     def create_stack(self):
-        signal.signal(signal.SIGINT, self.cancel_create)
+        self.validate_account(self.session, self.config)
+        self.register_interrupt(self.cancel_create, self.abort_create)
         if not self.transforms:
             # create the stack 
             start_time = datetime.now(pytz.utc)
             args = {
                 "StackName": self.stack_name,
-                "Parameters": self.config.build_params(self.session, self.stack, self.release, self.params, self.template_file),
+                "Parameters": self.config.build_params(self.session, self.stack, self.release, self.params, self.template_file, self.output_cache),
                 "DisableRollback": self.disable_rollback,
                 "Tags": self.construct_tags(),
                 "Capabilities": [
@@ -308,6 +431,8 @@ class Stack(AbstractCloudFormation):
             }
             args.update({'TemplateBody': self.template_body} if self.template_body else {"TemplateURL": self.template_url})
             args.update({'TimeoutInMinutes': self.timeout} if self.timeout else {})
+            if self.config.get_config_att('meta_tags') != False:
+                args['Tags'] = self.construct_tags(self.fingerprint(args))
             if self.template_body:
                 logger.info("Using local template due to null template bucket")
             self.client.create_stack(**args)
@@ -318,14 +443,16 @@ class Stack(AbstractCloudFormation):
             self.get_change_set(change_set_name, "Deployer Automated", 'CREATE')
             self.execute_change_set(change_set_name)
             self.create_waiter(start_time)
+        self.forget_outputs()
 
     def update_stack(self):
-        signal.signal(signal.SIGINT, self.cancel_update)
+        self.validate_account(self.session, self.config)
+        self.register_interrupt(self.cancel_update, self.abort_update)
         if not self.transforms:
             start_time = datetime.now(pytz.utc)
             args = {
                 "StackName": self.stack_name,
-                "Parameters": self.config.build_params(self.session, self.stack, self.release, self.params, self.template_file),
+                "Parameters": self.config.build_params(self.session, self.stack, self.release, self.params, self.template_file, self.output_cache),
                 "DisableRollback": self.disable_rollback,
                 "Tags": self.construct_tags(),
                 "Capabilities": [
@@ -338,6 +465,12 @@ class Stack(AbstractCloudFormation):
             if self.template_body:
                 logger.info("Using local template due to null template bucket")
             if self.stack_status:
+                if self.config.get_config_att('meta_tags') != False:
+                    fingerprint = self.fingerprint(args)
+                    if not self.force and fingerprint == self.deployed_fingerprint():
+                        logger.info("Stack is unchanged since its last deploy, skipping update")
+                        return
+                    args['Tags'] = self.construct_tags(fingerprint)
                 try:
                     self.client.update_stack(**args)
                     self.update_waiter(start_time)
@@ -360,6 +493,19 @@ class Stack(AbstractCloudFormation):
             self.get_change_set(change_set_name, "Deployer Automated", 'UPDATE')
             self.execute_change_set(change_set_name)
             self.update_waiter(start_time)
+        self.forget_outputs()
+
+    def forget_outputs(self):
+        # Stacks looking this one up next must see its new outputs
+        self.output_cache.invalidate(self.session, self.stack_name)
+
+    def register_interrupt(self, handler, abort):
+        # Signal handlers can only be installed from the main thread, worker
+        # threads leave abort for the main thread to call on Ctrl-C
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGINT, handler)
+        else:
+            interrupts.register(abort)
 
     def cancel_create(self, signal, frame):
         logger.critical('Process Interupt')
@@ -373,6 +519,14 @@ class Stack(AbstractCloudFormation):
         self.client.cancel_update_stack(StackName=self.stack_name)
         exit(1)
 
+    def abort_create(self):
+        logger.critical('Deleteing Stack: %s' % self.stack_name)
+        self.client.delete_stack(StackName=self.stack_name)
+
+    def abort_update(self):
+        logger.critical('Cancelling Stack Update: %s' % self.stack_name)
+        self.client.cancel_update_stack(StackName=self.stack_name)
+
     @retry(ClientError,logger=logger)
     def get_outputs(self):
         resp = self.client.describe_stacks(
@@ -390,6 +544,8 @@ class Stack(AbstractCloudFormation):
             resp = self.client.describe_stacks(
                 StackName=self.stack_name)
             self.stack_status = resp['Stacks'][0]['StackStatus']
+            self.stack_status_reason = resp['Stacks'][0].get('StackStatusReason')
         except Exception:
             self.stack_status = 'False'
+            self.stack_status_reason = None
         return self.stack_status
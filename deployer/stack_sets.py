@@ -7,6 +7,8 @@ from botocore.exceptions import ClientError
 from collections import defaultdict
 
 from deployer.cloudformation import AbstractCloudFormation
+from deployer.exceptions import AccountValidationError
+from deployer.identity import caller_identity
 from deployer.logger import logger
 
 
@@ -23,13 +25,14 @@ class StackSet(AbstractCloudFormation):
 
 
         self.params = args.get('params', {})
+        self.output_cache = args.get('outputs')
 
         self.print_events = args.get('print_events', False)
 
         # Load values from methods for config lookup
         self.base = self.config.get_config_att('sync_base', '.')
         self.repository = self.get_repository(self.base)
-        self.commit = self.repository.head.object.hexsha if self.repository else 'null'
+        self.commit = (self.repository.commit if self.repository else None) or 'null'
 
         # Load values from config
         self.release = self.config.get_config_att('release', self.commit).replace('/','.')
@@ -46,7 +49,7 @@ class StackSet(AbstractCloudFormation):
 
         # Load values from methods
         self.origin = self.get_repository_origin(self.repository) if self.repository else 'null'
-        self.identity_arn = self.sts.get_caller_identity().get('Arn', '')
+        self.identity_arn = caller_identity(self.session).get('Arn', '')
         self.template_url = self.bucket.construct_template_url(self.config, self.stack, self.release, self.template) # self.construct_template_url()
         self.template_file = self.bucket.get_template_file(self.config, self.stack)
         self.template_body = self.bucket.get_template_body(self.config, self.template)
@@ -81,7 +84,7 @@ class StackSet(AbstractCloudFormation):
 
     @property
     def current_account(self):
-        return self.session.client('sts').get_caller_identity().get('Account', None)
+        return caller_identity(self.session).get('Account', None)
 
     @property
     def stack_instances(self):
@@ -109,8 +112,7 @@ class StackSet(AbstractCloudFormation):
     def validate_account(self):
         current = self.current_account
         if self.account is not None and current != self.account:
-            logger.error("Account validation failed. Expected '{}' but received '{}'".format(self.account, current))
-            exit(1)
+            raise AccountValidationError("Account validation failed. Expected '{}' but received '{}'".format(self.account, current))
 
     def create_stack(self):
 
@@ -120,7 +122,7 @@ class StackSet(AbstractCloudFormation):
                 'CAPABILITY_NAMED_IAM',
                 'CAPABILITY_AUTO_EXPAND'
             ],
-            "Parameters": self.config.build_params(self.session, self.stack, self.release, self.params, self.template_file),
+            "Parameters": self.config.build_params(self.session, self.stack, self.release, self.params, self.template_file, self.output_cache),
             'StackSetName': self.stack_name,
             "Tags": self.construct_tags()
         }
@@ -186,7 +188,7 @@ class StackSet(AbstractCloudFormation):
                 'CAPABILITY_NAMED_IAM',
                 'CAPABILITY_AUTO_EXPAND'
             ],
-            "Parameters": self.config.build_params(self.session, self.stack, self.release, self.params, self.template_file),
+            "Parameters": self.config.build_params(self.session, self.stack, self.release, self.params, self.template_file, self.output_cache),
             'StackSetName': self.stack_name,
             "Tags": self.construct_tags(),
         }
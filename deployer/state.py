@@ -0,0 +1,14 @@
+import os
+
+
+# Set by --state-dir, DEPLOYER_STATE_DIR is used otherwise
+directory = None
+
+def state_path(*parts):
+    # Caches, indexes and journals all live under one directory, outside of
+    # the config repository unless told otherwise
+    base = directory or os.environ.get('DEPLOYER_STATE_DIR')
+    if not base:
+        cache = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        base = os.path.join(cache, 'deployer')
+    return os.path.join(base, *parts)
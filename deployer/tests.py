@@ -2,7 +2,7 @@ import unittest
 import __init__ as deployer
 import boto3, json
 import sys, subprocess, os, shutil, time
-from botocore.exceptions import ClientError
+from botocore.exceptions import ClientError, WaiterError
 import yaml
 from datetime import tzinfo, timedelta, datetime
 
@@ -50,6 +50,51 @@ timeout:
 """
 
 
+class FakeSTS(object):
+    def __init__(self, session):
+        self.session = session
+
+    def get_caller_identity(self):
+        return {'Account': self.session.arn.split(':')[4], 'Arn': self.session.arn}
+
+
+class FakeSession(object):
+    """Stand-in for a boto3 session in unit tests.
+
+    ``clients`` and ``resources`` map service names to the fakes handed out.
+    Unless a fake is given for it, STS answers with ``arn``. Every service a
+    client is created for is recorded in ``created``.
+    """
+
+    def __init__(self, clients=None, resources=None, region_name='us-east-1', profile_name=None,
+                 arn='arn:aws:iam::123456789012:user/test'):
+        self.clients = clients or {}
+        self.resources = resources or {}
+        self.region_name = region_name
+        self.profile_name = profile_name
+        self.arn = arn
+        self.created = []
+
+    def get_credentials(self):
+        return None
+
+    def client(self, service, config=None):
+        self.created.append(service)
+        if service == 'sts' and service not in self.clients:
+            return FakeSTS(self)
+        return self.clients[service]
+
+    def resource(self, service, config=None):
+        return self.resources[service]
+
+
+class FakeSessionTestCase(unittest.TestCase):
+    # Identities are cached per process, every test starts without them
+    def setUp(self):
+        from deployer.identity import clear_identities
+        clear_identities()
+
+
 cloudformation = boto3.client('cloudformation', region_name="us-east-1")
 simplestorageservice = boto3.client('s3', region_name="us-east-1")
 
@@ -460,6 +505,1089 @@ class IntegrationStackSetTestCase(unittest.TestCase):
         self.stackset_delete()
 
 
+class ExecutorTestCase(unittest.TestCase):
+    graph = {
+        'network': [],
+        'database': ['network'],
+        'app': ['database', 'network'],
+        'monitoring': []
+    }
+    order = ['network', 'database', 'app', 'monitoring']
+
+    def test_parallel_order(self):
+        from deployer.executor import DeploymentExecutor, SUCCEEDED
+        finished = []
+        def worker(stack):
+            for parent in self.graph[stack]:
+                self.assertIn(parent, finished)
+            finished.append(stack)
+        results = DeploymentExecutor(self.graph, jobs=4).run(self.order, worker)
+        self.assertEqual(set(finished), set(self.order))
+        self.assertTrue(all(x == SUCCEEDED for x in results.values()))
+
+    def test_keep_going(self):
+        from deployer.executor import DeploymentExecutor, SKIPPED, FAILED, SUCCEEDED
+        from deployer.exceptions import DeploymentError
+        def worker(stack):
+            if stack == 'database':
+                raise RuntimeError("failed")
+        executor = DeploymentExecutor(self.graph, jobs=2, keep_going=True)
+        self.assertRaises(DeploymentError, executor.run, self.order, worker)
+        self.assertEqual(executor.results['database'], FAILED)
+        self.assertEqual(executor.results['app'], SKIPPED)
+        self.assertEqual(executor.results['monitoring'], SUCCEEDED)
+
+    def test_parallel_failure_stops(self):
+        from deployer.executor import DeploymentExecutor, SKIPPED, FAILED
+        from deployer.exceptions import DeploymentError
+        stacks = [str(x) for x in range(10)]
+        started = []
+        def worker(stack):
+            started.append(stack)
+            if stack == '0':
+                raise RuntimeError("failed")
+            time.sleep(0.05)
+        executor = DeploymentExecutor(dict((x, []) for x in stacks), jobs=2)
+        self.assertRaises(DeploymentError, executor.run, stacks, worker)
+        self.assertEqual(executor.results['0'], FAILED)
+        self.assertEqual(sorted(started), ['0', '1'])
+        self.assertTrue(all(executor.results[x] == SKIPPED for x in stacks[2:]))
+
+    def test_interrupt(self):
+        from deployer import interrupts
+        from deployer.executor import DeploymentExecutor
+        import _thread, threading
+        release = threading.Event()
+        registered = threading.Event()
+        cancelled = []
+        def worker(stack):
+            if stack == 'network':
+                # Finished stacks are not cancelled
+                interrupts.register(lambda: cancelled.append('network'))
+                return
+            interrupts.register(lambda: cancelled.append(stack))
+            if stack == 'monitoring':
+                registered.set()
+            else:
+                registered.wait(5)
+                _thread.interrupt_main()
+            release.wait(5)
+        executor = DeploymentExecutor(self.graph, jobs=3)
+        start = time.time()
+        try:
+            self.assertRaises(KeyboardInterrupt, executor.run, self.order, worker)
+            self.assertLess(time.time() - start, 4)
+            self.assertEqual(sorted(cancelled), ['database', 'monitoring'])
+            self.assertEqual(interrupts.cancels, {})
+        finally:
+            release.set()
+
+
+class PlanTestCase(unittest.TestCase):
+    config = {
+        'global': { 'region': 'us-east-1' },
+        'app': { 'lookup_parameters': { 'Db': { 'Stack': 'database', 'OutputKey': 'Db' } }, 'depends_on': [ 'network' ] },
+        'database': { 'lookup_parameters': { 'Vpc': { 'Stack': 'network', 'OutputKey': 'Vpc' } } },
+        'network': {},
+        'monitoring': {}
+    }
+
+    def test_levels(self):
+        from deployer.plan import DeploymentPlan
+        plan = DeploymentPlan(self.config)
+        self.assertEqual(plan.levels, [['network', 'monitoring'], ['database'], ['app']])
+        self.assertEqual(plan.critical_path, ['network', 'database', 'app'])
+        self.assertEqual(plan.order.index('network') < plan.order.index('database') < plan.order.index('app'), True)
+
+    def test_subset(self):
+        from deployer.plan import DeploymentPlan
+        plan = DeploymentPlan(self.config)
+        self.assertEqual(plan.dependencies('app'), ['network', 'database'])
+        self.assertEqual(plan.dependents('network'), ['database', 'app'])
+        subset = plan.subset(['database'] + plan.dependents('database'))
+        self.assertEqual(subset.levels, [['database'], ['app']])
+
+    def test_reverse(self):
+        from deployer.plan import DeploymentPlan
+        plan = DeploymentPlan(self.config).reverse()
+        self.assertEqual(plan.levels, [['app', 'monitoring'], ['database'], ['network']])
+        self.assertEqual(plan.graph['network'], ['database', 'app'])
+
+    def test_import_dependencies(self):
+        from deployer.plan import DeploymentPlan
+        import tempfile
+        directory = tempfile.mkdtemp()
+        exporter = os.path.join(directory, 'network.yaml')
+        importer = os.path.join(directory, 'service.yaml')
+        with open(exporter, 'w') as f:
+            f.write('Outputs:\n  Vpc:\n    Value: vpc\n    Export:\n      Name: !Sub "${AWS::StackName}-Vpc"\n')
+        with open(importer, 'w') as f:
+            f.write('Resources:\n  Group:\n    Properties:\n      VpcId: !ImportValue network-Vpc\n')
+        config = dict(self.config,
+            network={ 'stack_name': 'network', 'template': exporter },
+            monitoring={ 'stack_name': 'monitoring', 'template': importer },
+            queue={ 'lookup_parameters': { 'Vpc': { 'Export': 'network-Vpc' } } })
+        plan = DeploymentPlan(config)
+        shutil.rmtree(directory, ignore_errors=True)
+        self.assertEqual(plan.graph['monitoring'], ['network'])
+        self.assertEqual(plan.graph['queue'], ['network'])
+
+    def test_cycle(self):
+        from deployer.plan import DeploymentPlan, CircularDependencyError
+        config = dict(self.config, network={ 'depends_on': [ 'app' ] })
+        with self.assertRaises(CircularDependencyError) as context:
+            DeploymentPlan(config)
+        self.assertEqual(context.exception.path[0], context.exception.path[-1])
+        self.assertEqual(set(context.exception.path), set(['app', 'database', 'network']))
+
+
+class JournalTestCase(unittest.TestCase):
+    def test_resume(self):
+        from deployer.journal import RunJournal
+        import tempfile
+        directory = tempfile.mkdtemp()
+        journal = RunJournal('config.yml', 'release', directory)
+        journal.record('network', 'SUCCEEDED', 'abc')
+        journal.record('app', 'FAILED', 'def')
+
+        resumed = RunJournal('config.yml', 'release', directory, resume=True)
+        self.assertTrue(resumed.completed('network', 'abc'))
+        self.assertFalse(resumed.completed('network', 'changed'))
+        self.assertFalse(resumed.completed('app', 'def'))
+        self.assertFalse(RunJournal('config.yml', 'other', directory, resume=True).completed('network', 'abc'))
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+class StateTestCase(unittest.TestCase):
+    def test_state_dir(self):
+        from deployer import state
+        from deployer.cloudtools_bucket import CloudtoolsBucket
+        from deployer.journal import RunJournal
+        from deployer.outputs import OutputCache
+        from unittest import mock
+        import tempfile
+        directory = tempfile.mkdtemp()
+        with mock.patch.dict(os.environ, {'XDG_CACHE_HOME': os.path.join(directory, 'xdg')}):
+            os.environ.pop('DEPLOYER_STATE_DIR', None)
+            self.assertEqual(state.state_path('journal'), os.path.join(directory, 'xdg', 'deployer', 'journal'))
+            os.environ['DEPLOYER_STATE_DIR'] = os.path.join(directory, 'env')
+            self.assertEqual(OutputCache().cache_path(), os.path.join(directory, 'env', 'cache', 'stack-outputs.json'))
+            state.directory = os.path.join(directory, 'flag')
+            try:
+                self.assertEqual(CloudtoolsBucket.__new__(CloudtoolsBucket).cache_path(),
+                                 os.path.join(directory, 'flag', 'cache', 'cloudtools-buckets.json'))
+                journal = RunJournal('config.yml', 'release')
+                self.assertTrue(journal.path.startswith(os.path.join(directory, 'flag', 'journal') + os.sep))
+                self.assertTrue(os.path.isfile(journal.path))
+            finally:
+                state.directory = None
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+class ShardTestCase(unittest.TestCase):
+    def test_assign_shards(self):
+        from deployer.plan import DeploymentPlan
+        from deployer.shard import assign_shards
+        plan = DeploymentPlan(PlanTestCase.config)
+        assignments = assign_shards(plan, 2)
+        self.assertEqual(set(assignments.values()), set([0, 1]))
+        self.assertEqual(assignments['network'], assignments['app'])
+        self.assertNotEqual(assignments['network'], assignments['monitoring'])
+
+    def test_markers(self):
+        from deployer.shard import FileMarkerStore, ShardCoordinator
+        import tempfile
+        directory = tempfile.mkdtemp()
+        coordinator = ShardCoordinator(FileMarkerStore(directory), 'run', interval=0, timeout=60)
+        self.assertIsNone(coordinator.check('network'))
+        coordinator.publish('network', 'SUCCEEDED')
+        self.assertEqual(coordinator.check('network'), 'SUCCEEDED')
+        coordinator.publish('app', 'FAILED')
+        self.assertRaises(RuntimeError, coordinator.check, 'app')
+        # A stack whose marker never appears fails after the timeout
+        self.assertIsNone(coordinator.check('database'))
+        coordinator.started['database'] -= 61
+        self.assertRaises(RuntimeError, coordinator.check, 'database')
+        shutil.rmtree(directory, ignore_errors=True)
+
+    def test_foreign_stacks_do_not_hold_jobs(self):
+        from deployer.executor import DeploymentExecutor, SUCCEEDED
+        from deployer.shard import FileMarkerStore, ShardCoordinator
+        import tempfile, threading
+        # Shard 1 owns y and w, shard 2 owns z, x1 and x2
+        graph = {'y': [], 'z': ['y'], 'x1': ['z'], 'x2': ['z'], 'w': ['x1', 'x2']}
+        shards = {1: (['x1', 'x2', 'y', 'w'], ['x1', 'x2']), 2: (['y', 'z', 'x1', 'x2'], ['y'])}
+        directory = tempfile.mkdtemp()
+        results = {}
+
+        def run(shard):
+            stacks, foreign = shards[shard]
+            coordinator = ShardCoordinator(FileMarkerStore(directory), 'run', interval=0.01, timeout=5)
+            executor = DeploymentExecutor(graph, jobs=2)
+            results[shard] = executor.run(stacks, lambda x: coordinator.publish(x, SUCCEEDED),
+                                          dict((x, coordinator.check) for x in foreign), coordinator.interval)
+
+        threads = [threading.Thread(target=run, args=(x,)) for x in shards]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        shutil.rmtree(directory, ignore_errors=True)
+        self.assertEqual(sorted(results), [1, 2])
+        self.assertTrue(all(x == SUCCEEDED for shard in results.values() for x in shard.values()))
+
+
+class RegionTestCase(unittest.TestCase):
+    def test_fan_out(self):
+        from deployer.api import Deployer
+        import tempfile
+        directory = tempfile.mkdtemp()
+        config_file = os.path.join(directory, 'config.yml')
+        with open(config_file, 'w') as f:
+            yaml.dump({
+                'global': {'region': 'us-east-1'},
+                'network': {'stack_name': 'network', 'deploy_regions': ['us-west-2', 'eu-west-1'], 'region_jobs': 1},
+                'app': {'stack_name': 'app'}
+            }, f)
+        deployer = Deployer(config_file)
+        self.assertEqual(deployer.fan_out('network', lambda region: deployer.config_object('network', region).get_config_att('region')),
+                         {'us-west-2': 'us-west-2', 'eu-west-1': 'eu-west-1'})
+        self.assertEqual(deployer.fan_out('app', lambda region: deployer.config_object('app', region).get_config_att('region')), 'us-east-1')
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+class ConfigsTestCase(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+        for name in ['dev-us-east-1', 'prod-us-east-1', 'prod-eu-west-1']:
+            with open(os.path.join(self.directory, name + '.yml'), 'w') as f:
+                yaml.dump({'global': {'region': name.split('-', 1)[1]}, 'network': {'stack_name': name + '-network'}}, f)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def test_find_configs(self):
+        from deployer.exceptions import ConfigError
+        self.assertEqual(deployer.find_configs([self.path('prod-*.yml')]),
+                         [self.path('prod-eu-west-1.yml'), self.path('prod-us-east-1.yml')])
+        self.assertEqual(deployer.find_configs([self.path('dev-us-east-1.yml'), self.path('*-us-east-1.yml'), self.path('prod-*.yml')]),
+                         [self.path('dev-us-east-1.yml'), self.path('prod-us-east-1.yml'), self.path('prod-eu-west-1.yml')])
+        # Paths without a glob are left for the config loader to report
+        self.assertEqual(deployer.find_configs([self.path('missing.yml')]), [self.path('missing.yml')])
+        self.assertRaises(ConfigError, deployer.find_configs, [self.path('dev-*.yml'), self.path('test-*.yml')])
+
+    def test_shared_context(self):
+        from deployer.context import RunContext
+        from deployer.exceptions import DeploymentError
+        from deployer.executor import DeploymentExecutor, FAILED, SKIPPED
+        from collections import defaultdict
+        import argparse, contextlib, io, threading
+        lock = threading.Lock()
+        sessions = []
+        described = []
+
+        class Client(object):
+            def describe_stacks(self, StackName):
+                with lock:
+                    described.append(StackName)
+                return {'Stacks': [{'StackName': StackName, 'StackStatus': 'CREATE_COMPLETE'}]}
+
+        def session_factory(profile, region):
+            sessions.append(FakeSession({'cloudformation': Client()}, region_name=region, profile_name=profile))
+            return sessions[-1]
+
+        args = argparse.Namespace(stack='network', all=False, with_dependencies=False, with_dependents=False, plan=False,
+                                  execute='describe', zip_lambdas=False, timeout=None, sync=False, rollback=False,
+                                  events=False, force=False, assume_valid=False, debug=False)
+        colors = defaultdict(lambda: '')
+        context = RunContext('dev', session_factory)
+        configs = deployer.find_configs([self.path('*.yml')])
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            DeploymentExecutor(dict((x, []) for x in configs), 3).run(configs, lambda x: deployer.run_config(x, args, colors, {}, context))
+        self.assertEqual(sorted(described), ['dev-us-east-1-network', 'prod-eu-west-1-network', 'prod-us-east-1-network'])
+        # Configs in the same region share the session and its clients
+        self.assertEqual(sorted((x.profile_name, x.region_name) for x in sessions), [('dev', 'eu-west-1'), ('dev', 'us-east-1')])
+        self.assertTrue(all(sorted(x.created) == ['cloudformation', 'sts'] for x in sessions))
+
+        # A failed config stops the configs that were not started yet
+        args.stack = 'database'
+        executor = DeploymentExecutor(dict((x, []) for x in configs), 1)
+        self.assertRaises(DeploymentError, executor.run, configs, lambda x: deployer.run_config(x, args, colors, {}, context))
+        self.assertEqual([executor.results[x] for x in configs], [FAILED, SKIPPED, SKIPPED])
+
+
+class ConfigCacheTestCase(unittest.TestCase):
+    def test_load_config(self):
+        from deployer.configuration import Config, load_config
+        import tempfile
+        directory = tempfile.mkdtemp()
+        config_file = os.path.join(directory, 'config.yml')
+        with open(config_file, 'w') as f:
+            yaml.dump({'global': {'region': 'us-east-1', 'release': 'a'}, 'network': {'release': 'b'}}, f)
+        self.assertIs(load_config(config_file), load_config(config_file))
+        self.assertEqual(Config(config_file, 'network').get_config_att('release'), 'b')
+        self.assertEqual(Config(config_file, 'network').get_config_att('region'), 'us-east-1')
+
+        with open(config_file, 'w') as f:
+            yaml.dump({'global': {'region': 'us-west-2', 'release': 'a'}, 'network': {'release': 'b', 'template': 'network.yml'}}, f)
+        self.assertEqual(Config(config_file, 'network').get_config_att('region'), 'us-west-2')
+        self.assertEqual(load_config(config_file).attributes('network')['template'], 'network.yml')
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+    def test_config_directory(self):
+        from deployer.configuration import Config, load_config
+        import tempfile
+        directory = tempfile.mkdtemp()
+        config_dir = os.path.join(directory, 'config')
+        os.makedirs(config_dir)
+        blocks = {
+            'global': {'region': 'us-east-1'},
+            'network': {'stack_name': 'network'},
+            'app': {'stack_name': 'app', 'depends_on': ['network']}
+        }
+        for name, block in blocks.items():
+            with open(os.path.join(config_dir, name + '.yml'), 'w') as f:
+                yaml.dump(block, f)
+
+        config = load_config(config_dir)
+        config.index_file = os.path.join(directory, 'index.json')
+        self.assertEqual(list(config.data), ['global', 'app', 'network'])
+        self.assertEqual(config.blocks, {})
+        self.assertEqual(config.graph(), {'app': ['network'], 'network': []})
+        self.assertTrue(os.path.exists(config.index_file))
+
+        # A fresh index plans without parsing any stack file
+        config.blocks = {}
+        self.assertEqual(config.graph(), {'app': ['network'], 'network': []})
+        self.assertEqual(config.blocks, {})
+        self.assertEqual(Config(config_dir, 'app').get_config_att('region'), 'us-east-1')
+        self.assertEqual(sorted(config.blocks), ['app', 'global'])
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+class IdentityTestCase(FakeSessionTestCase):
+    def test_caller_identity(self):
+        from deployer.identity import caller_identity, clear_identities
+
+        class Credentials(object):
+            def __init__(self, access_key):
+                self.access_key = access_key
+
+        session = FakeSession(profile_name='test')
+        session.get_credentials = lambda: Credentials(session.access_key)
+        session.access_key = 'AKIA1'
+        self.assertEqual(caller_identity(session)['Account'], '123456789012')
+        caller_identity(session)
+        self.assertEqual(session.created, ['sts'])
+        session.access_key = 'AKIA2'
+        caller_identity(session)
+        self.assertEqual(session.created, ['sts', 'sts'])
+        clear_identities()
+        caller_identity(session)
+        self.assertEqual(session.created, ['sts', 'sts', 'sts'])
+
+    def test_lock_per_key(self):
+        from deployer.identity import caller_identity
+        import threading
+        started = threading.Event()
+        slow = threading.Event()
+        calls = []
+        timed_out = []
+
+        class STS(object):
+            def __init__(self, profile):
+                self.profile = profile
+            def get_caller_identity(self):
+                calls.append(self.profile)
+                if self.profile == 'slow':
+                    # Blocks until another profile's lookup went through
+                    started.set()
+                    timed_out.append(not slow.wait(2))
+                return {'Account': '123456789012', 'Arn': 'arn:aws:iam::123456789012:user/' + self.profile}
+
+        def session(profile):
+            return FakeSession({'sts': STS(profile)}, profile_name=profile)
+
+        identities = []
+        threads = [threading.Thread(target=lambda: identities.append(caller_identity(session('slow')))) for x in range(4)]
+        for thread in threads:
+            thread.start()
+        started.wait(2)
+        self.assertTrue(caller_identity(session('fast'))['Arn'].endswith('/fast'))
+        slow.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(calls), ['fast', 'slow'])
+        self.assertEqual(timed_out, [False])
+        self.assertEqual(len(identities), 4)
+
+
+class OutputCacheTestCase(FakeSessionTestCase):
+    def test_resolve(self):
+        from deployer.outputs import OutputCache
+        from deployer.exceptions import ConfigError
+        import tempfile
+        described = []
+        updated = {'network': datetime(2020, 1, 1), 'queue': datetime(2020, 1, 2)}
+
+        class Paginator(object):
+            def paginate(self, StackStatusFilter):
+                yield {'StackSummaries': [{'StackName': k, 'CreationTime': v} for k, v in updated.items()]}
+
+        class Exports(object):
+            def paginate(self):
+                described.append('exports')
+                yield {'Exports': [{'Name': 'network-VPC', 'Value': 'vpc-1'}]}
+                yield {'Exports': [{'Name': 'queue-Queue', 'Value': 'arn:queue'}]}
+
+        class CloudFormation(object):
+            def describe_stacks(self, StackName):
+                described.append(StackName)
+                outputs = {'network': {'VPC': 'vpc-1', 'Subnets': 'subnet-1,subnet-2'}, 'queue': {'Queue': 'arn:queue'}}
+                return {'Stacks': [{'StackStatus': 'CREATE_COMPLETE', 'CreationTime': updated[StackName],
+                                    'Outputs': [{'OutputKey': k, 'OutputValue': v} for k, v in outputs[StackName].items()]}]}
+            def get_paginator(self, operation):
+                return Exports() if operation == 'list_exports' else Paginator()
+
+        session = FakeSession({'cloudformation': CloudFormation()})
+        cache_file = os.path.join(tempfile.mkdtemp(), 'stack-outputs.json')
+        cache = OutputCache()
+        cache.cache_file = cache_file
+        lookups = {'VPC': ('network', 'VPC'), 'Subnets': ('network', 'Subnets'), 'Queue': ('queue', 'Queue')}
+        self.assertEqual(cache.resolve(session, lookups), {'VPC': 'vpc-1', 'Subnets': 'subnet-1,subnet-2', 'Queue': 'arn:queue'})
+        self.assertEqual(sorted(described), ['network', 'queue'])
+        cache.resolve(session, lookups)
+        self.assertEqual(len(described), 2)
+        with self.assertRaises(ConfigError):
+            cache.resolve(session, {'Missing': ('network', 'Missing')})
+        cache.invalidate(session, 'network')
+        cache.resolve(session, {'VPC': ('network', 'VPC')})
+        self.assertEqual(sorted(described), ['network', 'network', 'queue'])
+
+        # A later run only describes the stacks updated since
+        described[:] = []
+        updated['queue'] = datetime(2020, 2, 1)
+        cache = OutputCache()
+        cache.cache_file = cache_file
+        self.assertEqual(cache.resolve(session, lookups)['Queue'], 'arn:queue')
+        self.assertEqual(described, ['queue'])
+
+        # Exports come from one index shared by every lookup in the region
+        described[:] = []
+        self.assertEqual(cache.resolve(session, {}, {'VPC': 'network-VPC', 'Queue': 'queue-Queue'}), {'VPC': 'vpc-1', 'Queue': 'arn:queue'})
+        cache.resolve(session, {}, {'VPC': 'network-VPC'})
+        self.assertEqual(described, ['exports'])
+        with self.assertRaises(ConfigError):
+            cache.resolve(session, {}, {'Missing': 'network-Missing'})
+
+    def test_scope(self):
+        from deployer.context import RunContext
+        from deployer.service import DeployerService
+        import tempfile
+        directory = tempfile.mkdtemp()
+        config_file = os.path.join(directory, 'config.yml')
+        with open(config_file, 'w') as f:
+            yaml.dump({'global': {'region': 'us-east-1'}, 'network': {'stack_name': 'network'}}, f)
+        context = RunContext()
+        self.assertIs(context.outputs, context.outputs)
+        self.assertIsNot(context.outputs, RunContext().outputs)
+        # Every service job sees outputs changed since the previous one
+        service = DeployerService(context)
+        first, second = service.deployer(config_file), service.deployer(config_file)
+        self.assertIsNot(first.arguements['outputs'], second.arguements['outputs'])
+        self.assertIs(first.config, second.config)
+        service.pool.shutdown()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+class CloudtoolsBucketTestCase(FakeSessionTestCase):
+    def test_name_cache(self):
+        from deployer.cloudtools_bucket import CloudtoolsBucket
+        import tempfile
+        directory = tempfile.mkdtemp()
+        calls = []
+
+        class Client(object):
+            def get_parameter(self, Name):
+                calls.append('get_parameter')
+                return {'Parameter': {'Value': 'cloudtools-test'}}
+            def head_bucket(self, Bucket):
+                calls.append('head_bucket')
+
+        class Resource(object):
+            def Bucket(self, name):
+                return name
+
+        session = FakeSession({'ssm': Client(), 's3': Client()}, {'s3': Resource()})
+
+        class Bucket(CloudtoolsBucket):
+            cache_file = os.path.join(directory, 'buckets.json')
+
+        bucket = Bucket(session)
+        for x in range(100):
+            self.assertEqual(bucket.name, 'cloudtools-test')
+        self.assertEqual(calls, ['get_parameter', 'head_bucket'])
+        self.assertEqual(Bucket(session).name, 'cloudtools-test')
+        self.assertEqual(calls, ['get_parameter', 'head_bucket', 'head_bucket'])
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+class LazyStackTestCase(unittest.TestCase):
+    def test_describe(self):
+        from deployer.configuration import Config
+        from deployer.stack import Stack
+        import tempfile
+        directory = tempfile.mkdtemp()
+        config_file = os.path.join(directory, 'config.yml')
+        with open(config_file, 'w') as f:
+            yaml.dump({'global': {'region': 'us-east-1', 'account': '000000000000'}, 'network': {'stack_name': 'network'}}, f)
+        calls = []
+
+        class Client(object):
+            def describe_stacks(self, StackName):
+                calls.append(StackName)
+                return {'Stacks': [{'StackName': StackName, 'StackStatus': 'CREATE_COMPLETE'}]}
+
+        stack = Stack(FakeSession({'cloudformation': Client()}), 'network', Config(config_file, 'network'), None)
+        self.assertEqual(stack.describe()['StackStatus'], 'CREATE_COMPLETE')
+        self.assertEqual(calls, ['network'])
+        self.assertEqual(stack.stack_status, 'CREATE_COMPLETE')
+        self.assertEqual(stack.stack_status, 'CREATE_COMPLETE')
+        self.assertEqual(calls, ['network', 'network'])
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+class DeleteStackTestCase(FakeSessionTestCase):
+    def setUp(self):
+        super(DeleteStackTestCase, self).setUp()
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+        self.config_file = os.path.join(self.directory, 'config.yml')
+        with open(self.config_file, 'w') as f:
+            yaml.dump({'global': {'region': 'us-east-1'}, 'network': {'stack_name': 'network'}}, f)
+        self.stacks = {'network': {'StackStatus': 'CREATE_COMPLETE'}}
+        self.calls = []
+        self.invalidated = []
+        test = self
+
+        class Waiter(object):
+            def wait(self, StackName):
+                test.calls.append(('wait', StackName))
+                if test.fail_delete:
+                    test.stacks[StackName] = {'StackStatus': 'DELETE_FAILED', 'StackStatusReason': 'Bucket is not empty'}
+                    raise WaiterError('StackDeleteComplete', 'Waiter encountered a terminal failure state', {})
+                del test.stacks[StackName]
+
+        class Client(object):
+            def describe_stacks(self, StackName):
+                if StackName not in test.stacks:
+                    raise ClientError({'Error': {'Code': 'ValidationError', 'Message': 'Stack does not exist'}}, 'DescribeStacks')
+                return {'Stacks': [dict(test.stacks[StackName], StackName=StackName)]}
+            def delete_stack(self, StackName):
+                test.calls.append(('delete', StackName))
+            def get_waiter(self, name):
+                test.calls.append(('waiter', name))
+                return Waiter()
+
+        class Outputs(object):
+            def invalidate(self, session, stack_name):
+                test.invalidated.append(stack_name)
+
+        self.session = FakeSession({'cloudformation': Client()})
+        self.outputs = Outputs()
+        self.fail_delete = False
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def stack(self):
+        from deployer.configuration import Config
+        from deployer.stack import Stack
+        return Stack(self.session, 'network', Config(self.config_file, 'network'), None, {'outputs': self.outputs})
+
+    def test_delete(self):
+        self.assertTrue(self.stack().delete_stack())
+        self.assertEqual(self.calls, [('delete', 'network'), ('waiter', 'stack_delete_complete'), ('wait', 'network')])
+        self.assertEqual(self.invalidated, ['network'])
+
+        # Nothing left to delete
+        self.calls = []
+        self.assertTrue(self.stack().delete_stack())
+        self.assertEqual(self.calls, [])
+        self.assertEqual(self.invalidated, ['network'])
+
+    def test_delete_failed(self):
+        from deployer.exceptions import StackDeleteError
+        self.fail_delete = True
+        with self.assertRaises(StackDeleteError) as e:
+            self.stack().delete_stack()
+        self.assertEqual((e.exception.stack, e.exception.status, e.exception.reason), ('network', 'DELETE_FAILED', 'Bucket is not empty'))
+        self.assertIn('Bucket is not empty', str(e.exception))
+        self.assertIsInstance(e.exception.__cause__, WaiterError)
+        self.assertEqual(self.invalidated, [])
+
+
+class SyncTestCase(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.directory, 'cloudformation'))
+        with open(os.path.join(self.directory, 'cloudformation', 'network.yml'), 'w') as f:
+            f.write('Resources: {}')
+        self.config_file = os.path.join(self.directory, 'config.yml')
+        with open(self.config_file, 'w') as f:
+            yaml.dump({'global': {'region': 'us-east-1', 'release': 'test', 'sync_base': self.directory,
+                                  'sync_dirs': ['./cloudformation'], 'sync_dest_bucket': 'bucket'},
+                       'network': {}}, f)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_errors(self):
+        from deployer.configuration import Config
+        from deployer.exceptions import SyncError
+        from deployer.s3_sync import s3_sync
+        from boto3.exceptions import S3UploadFailedError
+        missing = ClientError({'Error': {'Code': '404', 'Message': 'Not Found'}}, 'GetObject')
+
+        class Client(object):
+            def get_object(self, **kwargs):
+                raise missing
+            def upload_file(self, fname, bucket, key):
+                raise S3UploadFailedError('Access Denied')
+
+        class Session(FakeSession):
+            def client(self, service, config=None):
+                if service == 'cloudformation':
+                    raise ClientError({'Error': {'Code': 'AccessDenied', 'Message': 'Denied'}}, 'CreateClient')
+                return super(Session, self).client(service, config)
+
+        class Bucket(object):
+            name = 'bucket'
+
+        config = Config(self.config_file, 'network')
+        with self.assertRaises(SyncError) as e:
+            s3_sync(Session({'s3': Client()}), config, Bucket(), valid=True)
+        self.assertIsInstance(e.exception.__cause__, ClientError)
+
+        with self.assertRaises(SyncError) as e:
+            s3_sync(FakeSession({'s3': Client(), 'cloudformation': Client()}), config, Bucket(), valid=True)
+        self.assertIn('test/cloudformation/network.yml', str(e.exception))
+        self.assertIsInstance(e.exception.__cause__, S3UploadFailedError)
+
+    def test_is_template(self):
+        from deployer.configuration import Config
+        from deployer.s3_sync import s3_sync
+        syncer = s3_sync(FakeSession({'s3': None, 'cloudformation': None}), Config(self.config_file, 'network'), None, auto_sync=False)
+        self.assertTrue(syncer.is_template('cloudformation/network.yml'))
+        self.assertTrue(syncer.is_template('templates/cloudformation-vpc.json'))
+        self.assertFalse(syncer.is_template('cloudformation/README.md'))
+        self.assertFalse(syncer.is_template('lambda/handler.yml'))
+
+
+class FingerprintTestCase(FakeSessionTestCase):
+    def setUp(self):
+        super(FingerprintTestCase, self).setUp()
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+        self.template = os.path.join(self.directory, 'top.yaml')
+        self.child = os.path.join(self.directory, 'nested', 'child.yaml')
+        os.makedirs(os.path.dirname(self.child))
+        with open(self.template, 'w') as f:
+            f.write('Parameters:\n  Release: {Type: String}\nResources:\n  Child:\n    Type: AWS::CloudFormation::Stack\n'
+                    '    Properties:\n      TemplateURL: !Sub "https://s3.amazonaws.com/${Bucket}/${Release}/nested/child.yaml"\n')
+        with open(self.child, 'w') as f:
+            f.write('Resources: {}\n')
+        self.config_file = os.path.join(self.directory, 'config.yml')
+        with open(self.config_file, 'w') as f:
+            yaml.dump({'global': {'region': 'us-east-1', 'release': 'fixed', 'sync_base': self.directory, 'tags': {'Team': 'a'}},
+                       'network': {'stack_name': 'network', 'template': self.template}}, f)
+        self.updates = []
+        self.deployed = {}
+        test = self
+
+        class Client(object):
+            def describe_stacks(self, StackName):
+                tags = [{'Key': k, 'Value': v} for k, v in test.deployed.items()]
+                return {'Stacks': [{'StackName': StackName, 'StackStatus': 'UPDATE_COMPLETE', 'Tags': tags}]}
+            def update_stack(self, **kwargs):
+                test.updates.append(kwargs)
+
+        self.session = FakeSession({'cloudformation': Client()}, arn='arn:aws:sts::123456789012:assumed-role/deploy/run-1')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def new_caller(self, arn):
+        from deployer.identity import clear_identities
+        self.session.arn = arn
+        clear_identities()
+
+    def stack(self, force=False, commit='a'):
+        from deployer.configuration import Config
+        from deployer.stack import Stack
+        stack = Stack(self.session, 'network', Config(self.config_file, 'network'), None, {'force': force})
+        stack.commit = commit
+        stack.template_body = None
+        stack.template_url = 'https://s3.amazonaws.com/bucket/{}/top.yaml'.format(stack.release)
+        stack.template_file = self.template
+        stack.update_waiter = lambda start_time: None
+        return stack
+
+    def args(self, stack, commit):
+        tags = stack.construct_tags()
+        for tag in tags:
+            if tag['Key'] == 'deployer:git:commit':
+                tag['Value'] = commit
+        return {'TemplateURL': stack.template_url, 'Parameters': [{'ParameterKey': 'Release', 'ParameterValue': 'fixed'}], 'Tags': tags}
+
+    def test_fingerprint(self):
+        stack = self.stack()
+        fingerprint = stack.fingerprint(self.args(stack, 'a'))
+        self.assertEqual(stack.nested_templates(self.template), [self.child])
+        # A new commit or caller does not change what is deployed
+        self.new_caller('arn:aws:sts::123456789012:assumed-role/deploy/run-2')
+        other = self.stack()
+        self.assertEqual(other.fingerprint(self.args(other, 'b')), fingerprint)
+        # A changed nested template does
+        with open(self.child, 'w') as f:
+            f.write('Resources: {Topic: {Type: AWS::SNS::Topic}}\n')
+        self.assertNotEqual(stack.fingerprint(self.args(stack, 'a')), fingerprint)
+
+    def test_skip_unchanged(self):
+        stack = self.stack()
+        stack.update_stack()
+        self.assertEqual(len(self.updates), 1)
+        self.deployed = dict((x['Key'], x['Value']) for x in self.updates[0]['Tags'])
+
+        self.new_caller('arn:aws:sts::123456789012:assumed-role/deploy/run-2')
+        self.stack().update_stack()
+        self.assertEqual(len(self.updates), 1)
+        self.stack(force=True).update_stack()
+        self.assertEqual(len(self.updates), 2)
+
+    def test_commit_release(self):
+        # Without a release the commit names the template folder and is
+        # passed as the Release parameter
+        with open(self.config_file, 'w') as f:
+            yaml.dump({'global': {'region': 'us-east-1', 'sync_base': self.directory, 'tags': {'Team': 'a'}},
+                       'network': {'stack_name': 'network', 'template': self.template}}, f)
+        self.stack(commit='a').update_stack()
+        self.assertEqual(len(self.updates), 1)
+        self.assertEqual(self.updates[0]['TemplateURL'], 'https://s3.amazonaws.com/bucket/a/top.yaml')
+        self.deployed = dict((x['Key'], x['Value']) for x in self.updates[0]['Tags'])
+        self.stack(commit='b').update_stack()
+        self.assertEqual(len(self.updates), 1)
+
+        # A release set in the config is deliberate and still counts
+        with open(self.config_file, 'w') as f:
+            yaml.dump({'global': {'region': 'us-east-1', 'release': 'v2', 'sync_base': self.directory, 'tags': {'Team': 'a'}},
+                       'network': {'stack_name': 'network', 'template': self.template}}, f)
+        self.stack().update_stack()
+        self.assertEqual(len(self.updates), 2)
+
+    def test_tag_limit(self):
+        with open(self.config_file, 'w') as f:
+            yaml.dump({'global': {'region': 'us-east-1', 'meta_tags': False, 'tags': dict(('Tag{}'.format(x), 'a') for x in range(46))},
+                       'network': {'stack_name': 'network', 'template': self.template}}, f)
+        self.assertEqual(len(self.stack().construct_tags()), 46)
+        with open(self.config_file, 'w') as f:
+            yaml.dump({'global': {'region': 'us-east-1', 'tags': dict(('Tag{}'.format(x), 'a') for x in range(46))},
+                       'network': {'stack_name': 'network', 'template': self.template}}, f)
+        self.assertRaises(ValueError, self.stack().construct_tags)
+
+
+class RepositoryTestCase(unittest.TestCase):
+    def test_repository(self):
+        from deployer.repository import get_repository
+        import tempfile
+        directory = tempfile.mkdtemp()
+        git_dir = os.path.join(directory, '.git')
+        os.makedirs(os.path.join(git_dir, 'refs', 'heads'))
+        os.makedirs(os.path.join(directory, 'cloudformation'))
+        with open(os.path.join(git_dir, 'HEAD'), 'w') as f:
+            f.write('ref: refs/heads/master\n')
+        with open(os.path.join(git_dir, 'packed-refs'), 'w') as f:
+            f.write('# pack-refs with: peeled fully-peeled sorted\n' + 'a' * 40 + ' refs/heads/master\n')
+        with open(os.path.join(git_dir, 'config'), 'w') as f:
+            f.write('[core]\n\tbare = false\n[remote "origin"]\n\turl = https://user@github.com/org/repo.git\n')
+
+        repository = get_repository(os.path.join(directory, 'cloudformation'))
+        self.assertIs(repository, get_repository(directory))
+        self.assertEqual(repository.commit, 'a' * 40)
+        self.assertEqual(repository.origin, 'github.com/org/repo.git')
+
+        # A loose ref takes priority over packed-refs
+        with open(os.path.join(git_dir, 'refs', 'heads', 'master'), 'w') as f:
+            f.write('b' * 40 + '\n')
+        self.assertEqual(repository.commit, 'b' * 40)
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+class ContextTestCase(unittest.TestCase):
+    def test_shared_clients(self):
+        from deployer.context import RunContext
+        import threading
+        session = FakeSession({'cloudformation': object()})
+        context = RunContext(session_factory=lambda profile, region: session, max_pool_connections=50)
+        clients = []
+        threads = [threading.Thread(target=lambda: clients.append(context.client('cloudformation', 'us-east-1'))) for x in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(session.created, ['cloudformation'])
+        self.assertEqual(len(set(id(x) for x in clients)), 1)
+        self.assertEqual(context.session('us-east-1').region_name, 'us-east-1')
+        self.assertEqual(context.session('us-east-1').config.max_pool_connections, 50)
+
+    def test_shared_role_credentials(self):
+        from deployer.context import RunContext
+        from dateutil.tz import tzutc
+        import threading
+        calls = []
+
+        class STS(object):
+            def assume_role(self, RoleArn, RoleSessionName):
+                calls.append(RoleArn)
+                # The first credentials are about to expire and get refreshed
+                expiration = datetime.now(tzutc()) + timedelta(minutes=1 if len(calls) == 1 else 60)
+                return {'Credentials': {'AccessKeyId': 'AKIA{}'.format(len(calls)), 'SecretAccessKey': 'secret',
+                                        'SessionToken': 'token', 'Expiration': expiration}}
+
+        context = RunContext(session_factory=lambda profile, region: FakeSession({'sts': STS()}))
+        role = 'arn:aws:iam::123456789012:role/deployer'
+        keys = []
+        def worker():
+            keys.append(context.session('us-east-1', role_arn=role).get_credentials().get_frozen_credentials().access_key)
+        threads = [threading.Thread(target=worker) for x in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(keys), 8)
+        self.assertTrue(set(keys) <= set(['AKIA1', 'AKIA2']))
+        self.assertIs(context.session('us-east-1', role_arn=role), context.session('us-east-1', role_arn=role))
+        self.assertEqual(context.session('us-east-1', role_arn=role).get_credentials().access_key, 'AKIA2')
+        self.assertEqual(calls, [role, role])
+
+
+class ServiceTestCase(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+        self.config = os.path.join(self.directory, 'config.yml')
+        with open(self.config, 'w') as f:
+            yaml.safe_dump({'global': {}, 'net': {}, 'app': {'depends_on': ['net']}}, f)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def wait(self, service, job_id):
+        for x in range(500):
+            job = service.job(job_id)
+            if job['state'] in ['SUCCEEDED', 'FAILED']:
+                return job
+            time.sleep(0.01)
+        self.fail("Job {} did not finish".format(job_id))
+
+    def test_submit(self):
+        from deployer.context import RunContext
+        from deployer.service import DeployerService
+        service = DeployerService(RunContext())
+        for request in [[], {'action': 'destroy', 'config': self.config, 'stack': 'net'},
+                        {'action': 'deploy', 'execute': 'replace', 'config': self.config, 'stack': 'net'},
+                        {'action': 'describe', 'stack': 'net'}, {'action': 'sync', 'config': self.config}]:
+            self.assertRaises(ValueError, service.submit, request)
+        self.assertEqual(service.list_jobs(), [])
+
+        job = service.submit({'action': 'plan', 'config': self.config})
+        self.assertIn(job['state'], ['QUEUED', 'RUNNING', 'SUCCEEDED'])
+        job = self.wait(service, job['id'])
+        self.assertEqual(job['state'], 'SUCCEEDED')
+        self.assertEqual(job['result']['levels'], [['net'], ['app']])
+        job = self.wait(service, service.submit({'action': 'plan', 'config': self.config, 'stack': 'db'})['id'])
+        self.assertEqual(job['state'], 'FAILED')
+        self.assertIsNone(service.job('missing'))
+
+    def test_history(self):
+        from deployer.context import RunContext
+        from deployer.service import DeployerService
+        service = DeployerService(RunContext())
+        service.history = 2
+        ids = []
+        for x in range(4):
+            ids.append(service.submit({'action': 'plan', 'config': self.config})['id'])
+            self.wait(service, ids[-1])
+        self.assertEqual([x['id'] for x in service.list_jobs()], ids[-2:])
+
+    def test_serialize_stack(self):
+        from deployer.context import RunContext
+        from deployer.service import DeployerService
+        import threading
+        lock = threading.Lock()
+        running = []
+        overlaps = []
+
+        class Deployer(object):
+            def deploy(self, stack, action):
+                with lock:
+                    running.append(stack)
+                    overlaps.append(list(running))
+                time.sleep(0.05)
+                with lock:
+                    running.remove(stack)
+
+        service = DeployerService(RunContext(), jobs=4)
+        service.deployer = lambda config_file: Deployer()
+        ids = [service.submit({'action': 'deploy', 'config': self.config, 'stack': x})['id'] for x in ['net', 'net', 'app', 'net']]
+        self.assertEqual([self.wait(service, x)['state'] for x in ids], ['SUCCEEDED'] * 4)
+        self.assertTrue(all(x.count('net') == 1 for x in overlaps))
+        self.assertTrue(any(len(x) == 2 for x in overlaps))
+
+    def test_stack_backlog(self):
+        from deployer.context import RunContext
+        from deployer.service import DeployerService
+        import threading
+        busy = threading.Event()
+        order = []
+
+        class Deployer(object):
+            def deploy(self, stack, action):
+                order.append((stack, action))
+                if stack == 'net':
+                    busy.wait(5)
+
+        service = DeployerService(RunContext(), jobs=2)
+        service.deployer = lambda config_file: Deployer()
+        ids = [service.submit({'action': 'deploy', 'config': self.config, 'stack': 'net', 'execute': x})['id'] for x in ['create', 'update', 'delete']]
+        # The queued jobs of net do not take the second worker
+        app = service.submit({'action': 'deploy', 'config': self.config, 'stack': 'app'})
+        self.assertEqual(self.wait(service, app['id'])['state'], 'SUCCEEDED')
+        self.assertFalse(busy.is_set())
+        self.assertEqual([service.job(x)['state'] for x in ids[1:]], ['QUEUED', 'QUEUED'])
+        busy.set()
+        self.assertEqual([self.wait(service, x)['state'] for x in ids], ['SUCCEEDED'] * 3)
+        self.assertEqual([x[1] for x in order if x[0] == 'net'], ['create', 'update', 'delete'])
+        self.assertEqual(service.stack_queues, {})
+
+    def test_http(self):
+        from deployer.context import RunContext
+        from deployer.service import DeployerService, make_server
+        import threading
+        try:
+            from urllib.request import Request, urlopen
+            from urllib.error import HTTPError
+        except ImportError:
+            from urllib2 import Request, urlopen, HTTPError
+        service = DeployerService(RunContext(), token='secret')
+        server = make_server(service, '127.0.0.1:0')
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        url = 'http://127.0.0.1:{}/jobs'.format(server.server_address[1])
+        def post(body, token='secret'):
+            headers = {'Authorization': 'Bearer ' + token} if token else {}
+            try:
+                response = urlopen(Request(url, json.dumps(body).encode('utf-8'), headers))
+                return response.getcode(), json.loads(response.read().decode('utf-8'))
+            except HTTPError as e:
+                return e.code, json.loads(e.read().decode('utf-8'))
+        try:
+            self.assertEqual(post({'action': 'plan', 'config': self.config}, None)[0], 401)
+            self.assertEqual(post({'action': 'plan', 'config': self.config}, 'wrong')[0], 401)
+            status, body = post({'action': 'destroy', 'config': self.config})
+            self.assertEqual((status, body), (400, {'error': "Unknown action 'destroy'."}))
+            status, body = post({'action': 'plan', 'config': self.config})
+            self.assertEqual(status, 202)
+            self.assertEqual(self.wait(service, body['id'])['state'], 'SUCCEEDED')
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+    def test_listen(self):
+        from deployer.context import RunContext
+        from deployer.exceptions import ConfigError
+        from deployer.service import DeployerService, make_server
+        service = DeployerService(RunContext())
+        self.assertRaises(ConfigError, make_server, service, '0.0.0.0:0')
+        self.assertRaises(ConfigError, make_server, service, '10.0.0.1:0')
+        path = os.path.join(self.directory, 'deployer.sock')
+        with open(path, 'w') as f:
+            f.write('keep')
+        self.assertRaises(ConfigError, make_server, service, None, path)
+        with open(path) as f:
+            self.assertEqual(f.read(), 'keep')
+        os.remove(path)
+        server = make_server(service, None, path)
+        server.server_close()
+        # A socket left behind by an earlier service is replaced
+        server = make_server(service, None, path)
+        server.server_close()
+
+
+class ProfileTestCase(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        from unittest import mock
+        self.directory = tempfile.mkdtemp()
+        config_file = os.path.join(self.directory, 'config')
+        with open(config_file, 'w') as f:
+            f.write('[profile dev]\naws_access_key_id = AKIADEV\naws_secret_access_key = secret\n')
+        environ = dict((k, v) for k, v in os.environ.items() if not k.startswith('AWS_'))
+        environ.update({'AWS_CONFIG_FILE': config_file, 'AWS_SHARED_CREDENTIALS_FILE': os.path.join(self.directory, 'credentials')})
+        self.environ = mock.patch.dict(os.environ, environ, clear=True)
+        self.environ.start()
+
+    def tearDown(self):
+        self.environ.stop()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_named_profile(self):
+        from deployer.context import RunContext
+        context = RunContext('dev')
+        self.assertEqual(context.session('us-east-1').get_credentials().access_key, 'AKIADEV')
+        # Later regions reuse the credentials resolved for the profile
+        west = context.session('us-west-2')
+        self.assertEqual(west.region_name, 'us-west-2')
+        self.assertEqual(west.get_credentials().access_key, 'AKIADEV')
+        role = context.session('us-east-1', role_arn='arn:aws:iam::123456789012:role/deployer')
+        self.assertEqual(role.region_name, 'us-east-1')
+        self.assertEqual(role.get_credentials().method, 'assume-role')
+
+
+class WatchTestCase(unittest.TestCase):
+    def test_changed(self):
+        from deployer.watch import Watcher
+        import tempfile
+        directory = tempfile.mkdtemp()
+        template = os.path.join(directory, 'template.yml')
+        with open(template, 'w') as f:
+            f.write('a')
+
+        class Syncer(object):
+            def files(self):
+                for fname in sorted(os.listdir(directory)):
+                    yield os.path.join(directory, fname), fname
+
+        watcher = Watcher(None, 'network')
+        watcher.syncer = Syncer()
+        self.assertEqual(watcher.changed(), [(template, 'template.yml')])
+        self.assertEqual(watcher.changed(), [])
+        with open(template, 'w') as f:
+            f.write('ab')
+        with open(os.path.join(directory, 'other.yml'), 'w') as f:
+            f.write('b')
+        self.assertEqual(watcher.changed(), [(os.path.join(directory, 'other.yml'), 'other.yml'), (template, 'template.yml')])
+        shutil.rmtree(directory, ignore_errors=True)
+
+
 # Used for UTC time
 ZERO = timedelta(0)
 class UTC(tzinfo):
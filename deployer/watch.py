@@ -0,0 +1,80 @@
+import os, time
+
+from deployer.logger import logger
+
+
+class Watcher(object):
+    """Keeps a stack's sync_dirs in step with the cloudtools bucket.
+
+    After one full sync, the files are polled for changes in size or
+    modification time. Only the files that changed are validated and
+    uploaded, and with ``change_sets`` a preview change set is printed when
+    the stack's template is one of them.
+    """
+
+    def __init__(self, deployer, stack, interval=2, change_sets=False):
+        self.deployer = deployer
+        self.stack = stack
+        self.interval = interval
+        self.change_sets = change_sets
+        self.syncer = None
+        self.syncers = []
+        self.files = {}
+
+    def snapshot(self):
+        # (mtime, size) of every synced file, keyed by path
+        files = {}
+        for fname, dest_key in self.syncer.files():
+            try:
+                stat = os.stat(fname)
+            except OSError:
+                continue
+            files[fname] = ((stat.st_mtime, stat.st_size), dest_key)
+        return files
+
+    def changed(self):
+        files = self.snapshot()
+        changed = [(x, y[1]) for x, y in files.items() if self.files.get(x, (None,))[0] != y[0]]
+        self.files = files
+        return sorted(changed)
+
+    def start(self):
+        # One syncer per region with deploy_regions, the first one walks the files
+        self.syncers = [self.deployer.syncer(self.stack, x) for x in self.deployer.regions(self.stack) or [None]]
+        self.syncer = self.syncers[0]
+        for syncer in self.syncers:
+            syncer.sync()
+        self.files = self.snapshot()
+        logger.info("Watching {} files for stack {}".format(len(self.files), self.stack))
+        while True:
+            time.sleep(self.interval)
+            self.poll()
+
+    def poll(self):
+        changed = self.changed()
+        if not changed:
+            return
+        try:
+            for fname, dest_key in changed:
+                if not self.syncer.valid and self.syncer.is_template(fname):
+                    self.syncer.validate_file(fname, dest_key)
+                for syncer in self.syncers:
+                    syncer.skip_or_send(fname, dest_key)
+            if self.change_sets and self.template_changed([x[0] for x in changed]):
+                self.preview()
+        except Exception as e:
+            # Keep watching, the next save may fix it
+            logger.error(e)
+
+    def template_changed(self, changed):
+        template = self.syncer.config.get_config_att('template', None)
+        if not template:
+            return False
+        paths = set(os.path.realpath(x) for x in [template, os.path.join(self.syncer.base, template)])
+        return any(os.path.realpath(x) in paths for x in changed)
+
+    def preview(self):
+        name = "deployer-watch-{}".format(int(time.time()))
+        env_stacks = self.deployer.change_set(self.stack, name, "Deployer watch preview")
+        for env_stack in env_stacks.values() if isinstance(env_stacks, dict) else [env_stacks]:
+            env_stack.client.delete_change_set(ChangeSetName=name, StackName=env_stack.stack_name)